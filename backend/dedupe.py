@@ -0,0 +1,122 @@
+"""
+Near-duplicate detection for annotations.
+
+Two annotations are considered duplicates when they have the same manuscript, verse and
+annotated_range and the same annotated_object and annotation once diacritics, tatweel, case and
+whitespace are normalized away. The server keeps a hash index on that key to check writes, and
+the report below groups whole manuscripts by the key in a single pass instead of comparing pairs:
+
+    python dedupe.py --resources ./resources Konduga Muenster
+"""
+import argparse
+import unicodedata
+
+import pandas as pd
+
+from ingest import load_manuscripts, manuscript_workbooks
+
+
+def normalize_for_dedupe(text):
+    if text is None or (isinstance(text, float) and pd.isna(text)):
+        return ''
+    # NFKD also folds presentation forms and splits hamza/madda from their alef
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c) and c != 'ـ')
+    stripped = stripped.replace('ٱ', 'ا')
+    return ' '.join(stripped.casefold().split())
+
+
+def dedupe_key(annotation, manuscript_id=None):
+    return (
+        str(manuscript_id if manuscript_id is not None else annotation.get('manuscript_id', '')),
+        str(annotation.get('verse_id', '') or '').strip(),
+        normalize_for_dedupe(annotation.get('annotated_object')),
+        normalize_for_dedupe(annotation.get('annotation')),
+        ''.join(str(annotation.get('annotated_range', '') or '').split()),
+    )
+
+
+class DuplicateIndex:
+    """Hash index from dedupe key to the annotation ids sharing it"""
+
+    def __init__(self):
+        self.ids_by_key = {}
+        self.key_by_id = {}
+
+    def build(self, manuscript_id, frame):
+        for annotation in frame.to_dict(orient='records'):
+            self.add(manuscript_id, annotation['annotation_id'], annotation)
+
+    def add(self, manuscript_id, annotation_id, annotation):
+        key = dedupe_key(annotation, manuscript_id)
+        self.ids_by_key.setdefault(key, []).append(str(annotation_id))
+        self.key_by_id[(manuscript_id, str(annotation_id))] = key
+
+    def remove(self, manuscript_id, annotation_id):
+        key = self.key_by_id.pop((manuscript_id, str(annotation_id)), None)
+        if key is None:
+            return
+        ids = [i for i in self.ids_by_key.get(key, []) if i != str(annotation_id)]
+        if ids:
+            self.ids_by_key[key] = ids
+        else:
+            self.ids_by_key.pop(key, None)
+
+    def update(self, manuscript_id, annotation_id, annotation):
+        self.remove(manuscript_id, annotation_id)
+        self.add(manuscript_id, annotation_id, annotation)
+
+    def find(self, manuscript_id, annotation, exclude_id=None):
+        """Id of an existing annotation that duplicates `annotation`, or None"""
+        for annotation_id in self.ids_by_key.get(dedupe_key(annotation, manuscript_id), []):
+            if annotation_id != exclude_id:
+                return annotation_id
+        return None
+
+
+def duplicate_report(manuscript_id, frame):
+    """Groups of annotation ids in a manuscript that share a dedupe key, largest groups first"""
+    if frame.empty:
+        return []
+    keys = pd.DataFrame({
+        'verse_id': frame['verse_id'].astype(str).str.strip(),
+        'annotated_object': frame['annotated_object'].map(normalize_for_dedupe),
+        'annotation': frame['annotation'].map(normalize_for_dedupe),
+        'annotated_range': frame['annotated_range'].astype(str).str.replace(r'\s+', '', regex=True),
+        'annotation_id': frame['annotation_id'].astype(str),
+    })
+    groups = keys.groupby(['verse_id', 'annotated_object', 'annotation', 'annotated_range'], sort=False)
+    report = []
+    for (verse_id, annotated_object, annotation, _), ids in groups['annotation_id']:
+        if len(ids) > 1:
+            report.append({
+                'manuscript_id': manuscript_id,
+                'verse_id': verse_id,
+                'annotated_object': annotated_object,
+                'annotation': annotation,
+                'annotation_ids': ids.tolist(),
+            })
+    report.sort(key=lambda group: len(group['annotation_ids']), reverse=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report near-duplicate annotations in manuscript workbooks")
+    parser.add_argument("manuscripts", nargs="*",
+                        help="manuscript ids to check (default: every workbook in the resources directory)")
+    parser.add_argument("--resources", default="./resources", help="directory holding the workbooks")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    manuscript_ids = args.manuscripts or manuscript_workbooks(args.resources)
+    for manuscript_id, frame in load_manuscripts(args.resources, manuscript_ids, workers=args.workers).items():
+        groups = duplicate_report(manuscript_id, frame)
+        duplicates = sum(len(group['annotation_ids']) - 1 for group in groups)
+        print(f"{manuscript_id}: {duplicates} duplicate annotations in {len(groups)} groups")
+        for group in groups:
+            print(f"  {group['verse_id']} {group['annotated_object']!r} -> {group['annotation']!r}: "
+                  f"{', '.join(group['annotation_ids'])}")
+
+
+if __name__ == '__main__':
+    main()
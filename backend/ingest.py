@@ -0,0 +1,139 @@
+"""
+Streaming, parallel loading of the manuscript annotation workbooks.
+
+Each workbook is read with openpyxl's read-only mode, one row at a time, and every cell is
+normalized (types, missing values) while streaming, so no intermediate full-frame copies are made.
+Several workbooks are parsed in parallel with a process pool, both when the server starts and
+from the command line to rebuild the workbooks offline:
+
+    python ingest.py rebuild --resources ./resources --workers 4
+"""
+import argparse
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import openpyxl
+import pandas as pd
+
+annotation_columns = ["annotation_id", "verse_id", "annotated_object", "annotation", "annotation_Language",
+                      "annotation_transliteration", "annotation_type", "other", "manuscript_id", "annotated_range",
+                      "flag"]
+
+# Workbooks in the resources directory that do not hold manuscript annotations
+non_manuscript_workbooks = {"saved_templates.xlsx"}
+
+
+def manuscript_workbooks(directory):
+    """Ids of the manuscripts with a workbook in the directory, sorted"""
+    return sorted(
+        name[:-len(".xlsx")] for name in os.listdir(directory)
+        if name.endswith(".xlsx") and name not in non_manuscript_workbooks
+    )
+
+
+def normalize_flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() == 'true'
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return False
+    return bool(value)
+
+
+def normalize_cell(value):
+    """Turn a cell into the string the server works with: missing values become '' and 3.0 becomes '3'"""
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ''
+        if value.is_integer():
+            value = int(value)
+    value = str(value)
+    return '' if value == 'nan' else value
+
+
+def read_annotation_workbook(path, manuscript_id):
+    """Stream the first sheet of a manuscript workbook into an annotation DataFrame"""
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        # Saved dimensions are not always reliable, let openpyxl discover them while reading
+        sheet.reset_dimensions()
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, ())
+        named = [(index, str(name)) for index, name in enumerate(header) if name is not None]
+        data = {column: [] for _, column in named}
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            for index, column in named:
+                value = row[index] if index < len(row) else None
+                data[column].append(normalize_flag(value) if column == 'flag' else normalize_cell(value))
+    finally:
+        workbook.close()
+
+    frame = pd.DataFrame(data, columns=[column for _, column in named])
+    frame['manuscript_id'] = manuscript_id
+    if "annotation_id" not in frame.columns:
+        frame.insert(0, 'annotation_id', [str(i) for i in range(len(frame))])
+    if "flag" not in frame.columns:
+        frame['flag'] = False
+    return frame
+
+
+def process_pool(workers):
+    # Only fork-based pools are used: with spawn the children would re-run the server module on import
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+
+
+def parallel_map(function, *iterables, workers=None):
+    jobs = list(zip(*iterables))
+    workers = workers or min(len(jobs), os.cpu_count() or 1)
+    pool = process_pool(workers) if workers > 1 and len(jobs) > 1 else None
+    if pool is None:
+        return [function(*job) for job in jobs]
+    with pool:
+        return list(pool.map(function, *zip(*jobs)))
+
+
+def load_manuscripts(directory, manuscript_ids, workers=None):
+    """Parse the workbooks of the given manuscripts that exist in `directory`, in parallel"""
+    existing = [m for m in manuscript_ids if os.path.exists(os.path.join(directory, f"{m}.xlsx"))]
+    paths = [os.path.join(directory, f"{m}.xlsx") for m in existing]
+    return dict(zip(existing, parallel_map(read_annotation_workbook, paths, existing, workers=workers)))
+
+
+def rebuild_workbook(path, manuscript_id):
+    """Re-parse a workbook and write it back with normalized values, returning the number of rows"""
+    frame = read_annotation_workbook(path, manuscript_id)
+    frame.to_excel(path, index=False)
+    return len(frame)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline tools for the manuscript annotation workbooks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild", help="re-parse and rewrite manuscript workbooks in parallel")
+    rebuild.add_argument("manuscripts", nargs="*",
+                         help="manuscript ids to rebuild (default: every workbook in the resources directory)")
+    rebuild.add_argument("--resources", default="./resources", help="directory holding the workbooks")
+    rebuild.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    manuscript_ids = args.manuscripts or manuscript_workbooks(args.resources)
+    paths = [os.path.join(args.resources, f"{m}.xlsx") for m in manuscript_ids]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        parser.error(f"workbooks not found: {', '.join(missing)}")
+
+    counts = parallel_map(rebuild_workbook, paths, manuscript_ids, workers=args.workers)
+    for manuscript_id, count in zip(manuscript_ids, counts):
+        print(f"{manuscript_id}: {count} annotations")
+
+
+if __name__ == '__main__':
+    main()
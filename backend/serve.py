@@ -0,0 +1,93 @@
+"""
+Pre-fork server for the annotation backend.
+
+The master process imports the app once - loading the verse table, its indexes and the packed
+verse store (see verse_store.py) and every manuscript - then forks the workers. The verse data is
+immutable, so the workers keep sharing the master's pages instead of each loading and holding a
+copy. All workers accept connections from one listening socket bound by the master.
+
+Writes are coordinated through the change log: each worker replays the annotations and templates
+written by the others before handling a request (see enable_shared_state in server.py).
+
+    python serve.py --host 0.0.0.0 --port 5000 --workers 4
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+
+from werkzeug.serving import make_server
+
+
+def serve_worker(app, host, port, sock):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+    finally:
+        os._exit(0)
+
+
+def spawn_worker(app, host, port, sock):
+    pid = os.fork()
+    if pid == 0:
+        serve_worker(app, host, port, sock)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the annotation backend from several forked workers")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=5000, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    args = parser.parse_args()
+
+    import server
+    server.enable_shared_state()
+    # Move everything loaded so far out of the collector's reach, so collections in the workers do
+    # not write to (and thereby copy) the pages holding the shared data
+    gc.collect()
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    workers = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(max(1, args.workers)):
+        workers.add(spawn_worker(server.app, args.host, args.port, sock))
+    print(f"Serving on http://{args.host}:{args.port} with {len(workers)} workers")
+
+    while workers:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            # Replace a worker that died
+            workers.add(spawn_worker(server.app, args.host, args.port, sock))
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,36 @@
 import unicodedata
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g
 import pandas as pd
 from flask_cors import CORS
+from collections import deque
+from functools import lru_cache
+from contextlib import contextmanager
+from datetime import datetime
 import numpy as np
+import openpyxl
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+import tempfile
+import threading
+import time
+import csv
+import io
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the single-process development server is supported there
+    fcntl = None
 import json
 import os
 import re
 
+from ingest import load_manuscripts, annotation_columns, normalize_flag
+from template_repository import TemplateRepository, template_fields
+from dedupe import DuplicateIndex, duplicate_report
+from token_index import TokenIndex
+from verse_store import VerseStore
+from verse_query import QueryPlanner, parse_range
+
 app = Flask(__name__)
 CORS(app)
 
@@ -32,12 +55,15 @@ def remove_diacritics(input_str):
     return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
 
-def normalize_arabic_text(text):
+def normalize_arabic_text(text, record=False):
     # http://www.isthisthingon.org/unicode/index.phtml?page=U0&subpage=6
     standard_arabic_characters = r'[^\u0621-\u063A\u0641-\u064A\s]'
-    global chars_to_normalize
-    non_standard_chars = re.findall(standard_arabic_characters, text)
-    chars_to_normalize.update(non_standard_chars)
+    if record:
+        # Only the one-off build of searchable_text collects these; request paths (the query
+        # planner, the word index) normalize user input and must not grow the set
+        global chars_to_normalize
+        non_standard_chars = re.findall(standard_arabic_characters, text)
+        chars_to_normalize.update(non_standard_chars)
 
     # Define a pattern for Arabic diacritics (tashkeel) including Warsh-specific ones
     arabic_diacritics = re.compile(r"""
@@ -88,47 +114,642 @@ df_verses = pd.read_excel('warshData_v2-1-searchable.xlsx', dtype=str)
 if 'AyahKey' not in df_verses.columns:
     df_verses['AyahKey'] = df_verses['sura_no'].astype(str) + ":" + df_verses['aya_no'].astype(str)
 if "searchable_text" not in df_verses.columns:
-    df_verses["searchable_text"] = df_verses["aya_text"].apply(normalize_arabic_text)
+    df_verses["searchable_text"] = df_verses["aya_text"].apply(normalize_arabic_text, record=True)
     df_verses.to_excel(f'warshData_v2-1-searchable.xlsx', index=False)
 
     df = pd.DataFrame(chars_to_normalize, columns=['chars_to_normalize'])
     output_file = 'chars_to_normalize.xlsx'
     df.to_excel(output_file, index=False)
 
+
+def build_verse_range_index(df, columns):
+    """
+    Build a sorted (value, row position) index for each numeric verse column so that a
+    value range like page 3-4 resolves with two binary searches instead of a full scan.
+    """
+    index = {}
+    for column in columns:
+        values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+        positions = np.flatnonzero(~np.isnan(values))
+        order = np.argsort(values[positions], kind='stable')
+        index[column] = (values[positions][order], positions[order])
+    return index
+
+
+# Mushaf layout columns that can be used to select a range of verses
+verse_range_columns = {"page": "page", "juz": "jozz", "sura": "sura_no"}
+verse_range_index = build_verse_range_index(df_verses, list(verse_range_columns.values()) + ["line_start", "line_end"])
+
+
+def verse_positions_in_range(column, low, high):
+    """Row positions of df_verses whose `column` value lies in [low, high], in mushaf order."""
+    values, positions = verse_range_index[column]
+    start = np.searchsorted(values, low, side='left')
+    stop = np.searchsorted(values, high, side='right')
+    return np.sort(positions[start:stop])
+
+
+# Word positions of every verse, used to place annotations on words (see token_index.py)
+token_index = TokenIndex(normalize_arabic_text)
+token_index.build_verses(df_verses['AyahKey'], df_verses['aya_text'])
+
+# Search data packed into flat shared buffers so forked workers share it (see verse_store.py)
+verse_store = VerseStore.from_frame(df_verses)
+
+verse_query_planner = QueryPlanner(
+    [(int(number), name_en, name_ar) for number, name_en, name_ar
+     in df_verses[['sura_no', 'sura_name_en', 'sura_name_ar']].dropna().drop_duplicates('sura_no').itertuples(index=False)],
+    normalize_arabic_text)
+no_verses = np.array([], dtype=np.int64)
+
+
+# The verse corpus never changes, so plans and their results can be cached for as long as the
+# process lives. Typeahead sends the same prefixes over and over.
+@lru_cache(maxsize=1024)
+def plan_verse_query(query):
+    return verse_query_planner.plan(query)
+
+
+@lru_cache(maxsize=1024)
+def execute_verse_plan(plan):
+    """Verse positions matching every term of a plan (see verse_query.py), in mushaf order"""
+    positions = None
+    text = None
+    for term in plan:
+        kind = term[0]
+        if kind == 'text':
+            text = term[1]
+            continue
+        if kind == 'key':
+            selected = verse_store.search_key_prefix(term[1])
+        elif kind == 'range':
+            selected = verse_positions_in_range(verse_range_columns[term[1]], term[2], term[3])
+        elif kind == 'suras':
+            selected = np.unique(np.concatenate(
+                [verse_positions_in_range(verse_range_columns['sura'], n, n) for n in term[1]]))
+        else:
+            selected = no_verses
+        positions = selected if positions is None else np.intersect1d(positions, selected)
+    # The text is searched last, only within the verses the index lookups selected
+    if text is not None and (positions is None or len(positions)):
+        positions = verse_store.search_text(text, positions)
+    positions = no_verses if positions is None else positions
+    # Shared by every later request for the same plan
+    positions.setflags(write=False)
+    return positions
+
+
+
+
 resources_directory = "./resources"
 
+# Low-cardinality annotation columns are held as pandas categoricals: every row stores a small
+# integer code and the code -> value mapping is kept once per column in its categories.
+categorical_annotation_columns = ["manuscript_id", "annotation_Language", "annotation_type", "verse_id", "flag"]
+
+
+def is_categorical(column):
+    return isinstance(column.dtype, pd.CategoricalDtype)
+
+
+def compact_annotation_frame(df):
+    """Dictionary-encode the low-cardinality columns of an annotation table"""
+    for column in categorical_annotation_columns:
+        if column in df.columns and not is_categorical(df[column]):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def register_categories(df, data):
+    """Add the values of an incoming write to the categories so the code -> value mapping stays current"""
+    for column in categorical_annotation_columns:
+        if column not in data or column not in df.columns or not is_categorical(df[column]):
+            continue
+        value = data[column]
+        if isinstance(value, (str, bool, int, float)) and not pd.isna(value) \
+                and value not in df[column].cat.categories:
+            df[column] = df[column].cat.add_categories([value])
+
+
+def write_annotation_workbook(manuscript_id, frame):
+    """
+    Write a manuscript's workbook from `frame` through a temporary file, so a failed write (a cell
+    openpyxl rejects, a full disk) leaves the previous workbook in place
+    """
+    path = os.path.join(resources_directory, f'{manuscript_id}.xlsx')
+    temporary_path = path + '.tmp'
+    try:
+        with open(temporary_path, 'wb') as workbook:
+            frame.to_excel(workbook, engine='openpyxl', index=False)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def append_annotation(manuscript_id, data, persist=False):
+    """
+    Append one annotation row, reusing the table's categories so the columns stay encoded. The new
+    table and the indexes are only installed once the workbook is written when `persist` is set.
+    """
+    # A shallow copy takes the new categories without touching the table readers still use
+    manuscript_annotations = annotations[manuscript_id].copy(deep=False)
+    register_categories(manuscript_annotations, data)
+    row = pd.DataFrame([data])
+    for column in categorical_annotation_columns:
+        if column in row.columns and is_categorical(manuscript_annotations[column]):
+            row[column] = pd.Categorical(row[column], categories=manuscript_annotations[column].cat.categories)
+    frame = compact_annotation_frame(pd.concat([manuscript_annotations, row], ignore_index=True))
+    if persist:
+        write_annotation_workbook(manuscript_id, frame)
+    annotations[manuscript_id] = frame
+    index_verse_annotations(manuscript_id, frame.tail(1))
+    duplicate_index.add(manuscript_id, data['annotation_id'], data)
+    token_index.add_annotation(manuscript_id, data['annotation_id'], data)
+    adjust_annotation_counts(manuscript_id, data, 1)
+    # Inserts replayed from other worker processes advance this process's id sequence too
+    note_annotation_id(manuscript_id, data['annotation_id'])
+
+
+def update_annotation_rows(manuscript_id, data, persist=False):
+    """
+    Apply an update payload to the row with the same annotation_id and return the updated rows.
+    The edit is made on a copy, installed once the workbook is written when `persist` is set.
+    """
+    frame = annotations[manuscript_id].copy()
+    register_categories(frame, data)
+    keys = list(data.keys())
+    values = list(data.values())
+    mask = frame['annotation_id'] == data['annotation_id']
+    previous = frame[mask].to_dict(orient='records')
+    frame.loc[mask, keys] = values
+    compact_annotation_frame(frame)
+    updated = frame[mask].to_dict(orient='records')
+    if persist:
+        write_annotation_workbook(manuscript_id, frame)
+    annotations[manuscript_id] = frame
+    for row in previous:
+        adjust_annotation_counts(manuscript_id, row, -1)
+    for row in updated:
+        adjust_annotation_counts(manuscript_id, row, 1)
+    refresh_verse_annotations(manuscript_id, {str(row['verse_id']) for row in previous + updated})
+    for row in updated:
+        duplicate_index.update(manuscript_id, row['annotation_id'], row)
+        token_index.update_annotation(manuscript_id, row['annotation_id'], row)
+    return updated
+
+
+def delete_annotation_rows(manuscript_id, annotation_id, persist=False):
+    """Remove the rows with the given annotation_id, once the workbook is written when `persist` is set"""
+    manuscript_annotations = annotations[manuscript_id]
+    mask = manuscript_annotations['annotation_id'] == annotation_id
+    removed = manuscript_annotations[mask].to_dict(orient='records')
+    frame = manuscript_annotations[~mask].reset_index(drop=True)
+    if persist:
+        write_annotation_workbook(manuscript_id, frame)
+    annotations[manuscript_id] = frame
+    for row in removed:
+        adjust_annotation_counts(manuscript_id, row, -1)
+    unindex_verse_annotations(manuscript_id, removed)
+    duplicate_index.remove(manuscript_id, annotation_id)
+    token_index.remove_annotation(manuscript_id, annotation_id)
+
+
+# Annotation rows of each manuscript grouped by verse_id, in table order, so reads of a verse's
+# annotations do not scan the tables: manuscript -> verse_id -> list of rows
+verse_annotations = {}
+
+
+def index_verse_annotations(manuscript_id, rows):
+    """Append the rows of a frame to the verse index"""
+    verses = verse_annotations.setdefault(manuscript_id, {})
+    for row in rows.to_dict(orient='records'):
+        verses.setdefault(str(row['verse_id']), []).append(row)
+
+
+def refresh_verse_annotations(manuscript_id, verse_ids):
+    """Re-read the rows of some verses from the table after their annotations changed"""
+    verses = verse_annotations.setdefault(manuscript_id, {})
+    for verse_id in verse_ids:
+        verses.pop(verse_id, None)
+    manuscript_annotations = annotations[manuscript_id]
+    index_verse_annotations(manuscript_id,
+                            manuscript_annotations[manuscript_annotations['verse_id'].isin(verse_ids)])
+
+
+def unindex_verse_annotations(manuscript_id, rows):
+    verses = verse_annotations.setdefault(manuscript_id, {})
+    for row in rows:
+        verse_id = str(row['verse_id'])
+        kept = [r for r in verses.get(verse_id, []) if r['annotation_id'] != row['annotation_id']]
+        if kept:
+            verses[verse_id] = kept
+        else:
+            verses.pop(verse_id, None)
+
+
+def find_annotation(manuscript_id, annotation_id):
+    manuscript_annotations = annotations[manuscript_id]
+    rows = manuscript_annotations[manuscript_annotations['annotation_id'] == annotation_id]
+    return rows.to_dict(orient='records')[0] if not rows.empty else None
+
+
+def duplicate_warning(manuscript_id, annotation, exclude_id=None):
+    """Warning for the response when `annotation` re-enters an existing annotation, else None"""
+    existing_id = duplicate_index.find(manuscript_id, annotation, exclude_id=exclude_id)
+    if existing_id is None:
+        return None
+    return {
+        'warning': 'Duplicate annotation',
+        'annotation_id': annotation.get('annotation_id'),
+        'manuscript_id': manuscript_id,
+        'duplicate_of': find_annotation(manuscript_id, existing_id)
+    }
+
+
+def matching_rows(column, value, partial=False):
+    """
+    Case-insensitive full or partial match of `value` against a column. For categorical columns
+    the string test runs once per category and rows are selected by comparing integer codes.
+    """
+    wanted = str(value).lower()
+    if is_categorical(column):
+        codes = [code for code, category in enumerate(column.cat.categories)
+                 if (wanted in str(category).lower() if partial else str(category).lower() == wanted)]
+        return np.isin(column.cat.codes.to_numpy(), codes)
+    text = column.astype(str).str.lower()
+    if partial:
+        return text.str.contains(wanted, regex=False).to_numpy()
+    return (text == wanted).to_numpy()
+
+
+def annotation_memory_report():
+    """Bytes per annotation with plain object columns (before) and with categorical columns (after)"""
+    report = []
+    for manuscript_id, manuscript_annotations in annotations.items():
+        plain = manuscript_annotations.astype({
+            column: manuscript_annotations[column].cat.categories.dtype
+            for column in categorical_annotation_columns
+            if column in manuscript_annotations.columns and is_categorical(manuscript_annotations[column])
+        })
+        bytes_before = int(plain.memory_usage(deep=True, index=False).sum())
+        bytes_after = int(manuscript_annotations.memory_usage(deep=True, index=False).sum())
+        rows = len(manuscript_annotations)
+        report.append({
+            'manuscript_id': manuscript_id,
+            'annotations': rows,
+            'bytes_before': bytes_before,
+            'bytes_after': bytes_after,
+            'bytes_per_annotation_before': round(bytes_before / rows, 1) if rows else 0,
+            'bytes_per_annotation_after': round(bytes_after / rows, 1) if rows else 0,
+        })
+    return report
+
+
 all_manuscripts = ["Konduga", "Muenster", "2ShK", "3ImI", "4MM", "Tahir Kano", "Kaduna-AR20", "Kaduna-AR33", "YM",
                    "Mutai", "BNF Arabe", "Gashi", "Zinder"]
+# Manuscript workbooks are streamed and parsed in parallel, see ingest.py
+loaded_annotations = load_manuscripts(resources_directory, all_manuscripts)
 annotations = {}
 for m_id in all_manuscripts:
-    if os.path.exists(os.path.join(resources_directory, f"{m_id}.xlsx")):
-        annotations[m_id] = pd.read_excel(os.path.join(resources_directory, f"{m_id}.xlsx"), dtype={
-            "annotation_id": str,
-            "verse_id": str,
-            "annotated_object": str,
-            "annotation": str,
-            "annotation_Language": str,
-            "annotation_transliteration": str,
-            "annotation_type": str,
-            "other": str,
-            "manuscript_id": str,
-            "annotated_range": str,
-            "flag": bool,
-        })
-        annotations[m_id] = annotations[m_id].replace('nan', '', regex=True)
-        annotations[m_id] = annotations[m_id].fillna('')
-        annotations[m_id]['manuscript_id'] = m_id
-        if "annotation_id" not in annotations[m_id].columns:
-            annotations[m_id].insert(0, 'annotation_id', range(0, len(annotations[m_id])))
-        if "flag" not in annotations[m_id].columns:
-            annotations[m_id]['flag'] = False
-
+    if m_id in loaded_annotations:
+        annotations[m_id] = loaded_annotations[m_id]
     else:
-        annotations[m_id] = pd.DataFrame(columns=["annotation_id", "verse_id", "annotated_object", "annotation",
-                                                  "annotation_Language", "annotation_transliteration",
-                                                  "annotation_type", "other", "manuscript_id", "annotated_range", "flag"
-                                                  ])
+        annotations[m_id] = pd.DataFrame(columns=annotation_columns)
         annotations[m_id].to_excel(os.path.join(resources_directory, f'{m_id}.xlsx'), index=False)
+    compact_annotation_frame(annotations[m_id])
+
+# Materialized annotation counts: verse_id -> {(manuscript_id, annotation_type, annotation_Language): count}.
+# Built with one groupby per manuscript at startup and adjusted by every write afterwards.
+annotation_counts = {}
+# Per-manuscript vocabularies: manuscript -> column -> value -> number of annotations using it
+vocabulary_columns = {'annotation_Language': 'languages', 'annotation_type': 'annotation_types'}
+vocabulary_counts = {}
+
+
+def count_value(value):
+    return '' if value is None or (isinstance(value, float) and np.isnan(value)) else str(value)
+
+
+def build_annotation_counts(manuscript_id, manuscript_annotations):
+    if manuscript_annotations.empty:
+        return
+    grouped = manuscript_annotations.groupby(['verse_id', 'annotation_type', 'annotation_Language'],
+                                             observed=True, dropna=False).size()
+    for (verse_id, annotation_type, language), count in grouped.items():
+        if count:
+            key = (manuscript_id, count_value(annotation_type), count_value(language))
+            verse_counts = annotation_counts.setdefault(count_value(verse_id), {})
+            verse_counts[key] = verse_counts.get(key, 0) + int(count)
+    manuscript_vocabulary = vocabulary_counts.setdefault(manuscript_id, {})
+    for column in vocabulary_columns:
+        values = manuscript_vocabulary.setdefault(column, {})
+        counts = manuscript_annotations[column].map(count_value).value_counts()
+        # Keep the order in which values first appear, as the old unique() lookups did
+        for value in manuscript_annotations[column].map(count_value).unique():
+            values[value] = values.get(value, 0) + int(counts[value])
+
+
+def adjust_vocabulary(manuscript_id, annotation, delta):
+    manuscript_vocabulary = vocabulary_counts.setdefault(manuscript_id, {})
+    for column in vocabulary_columns:
+        values = manuscript_vocabulary.setdefault(column, {})
+        value = count_value(annotation.get(column))
+        values[value] = values.get(value, 0) + delta
+        if values[value] <= 0:
+            del values[value]
+
+
+def vocabulary(manuscript_id, column):
+    """Distinct non-empty values of a column in a manuscript's annotations, in order of first use"""
+    return [value for value in vocabulary_counts.get(manuscript_id, {}).get(column, {}) if value != '']
+
+
+def adjust_annotation_counts(manuscript_id, annotation, delta):
+    verse_id = count_value(annotation.get('verse_id'))
+    key = (manuscript_id, count_value(annotation.get('annotation_type')),
+           count_value(annotation.get('annotation_Language')))
+    verse_counts = annotation_counts.setdefault(verse_id, {})
+    verse_counts[key] = verse_counts.get(key, 0) + delta
+    if verse_counts[key] <= 0:
+        del verse_counts[key]
+        if not verse_counts:
+            del annotation_counts[verse_id]
+    adjust_vocabulary(manuscript_id, annotation, delta)
+
+
+# Hash index on (manuscript, verse, normalized object and annotation, range) to catch re-entered annotations
+duplicate_index = DuplicateIndex()
+
+# Last annotation id issued per manuscript. The indexes and the change feed are keyed on
+# (manuscript, annotation_id), so ids are never reused, not even the newest one after it is
+# deleted and the server restarts; the sequence is persisted for that.
+annotation_sequence_file = os.path.join(resources_directory, "annotation_id_sequence.json")
+annotation_id_lock = threading.Lock()
+
+
+def read_annotation_sequence():
+    """The persisted last ids, as written by any server process"""
+    try:
+        with open(annotation_sequence_file, encoding='utf-8') as f:
+            return {m: int(n) for m, n in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+annotation_id_sequence = read_annotation_sequence()
+
+
+def note_annotation_id(manuscript_id, annotation_id):
+    """Make sure the sequence of a manuscript is past an id that is in use"""
+    try:
+        number = int(str(annotation_id))
+    except ValueError:
+        return
+    if number > annotation_id_sequence.get(manuscript_id, -1):
+        annotation_id_sequence[manuscript_id] = number
+
+
+def next_annotation_id(manuscript_id):
+    """Reserve and return the next annotation id of a manuscript"""
+    with annotation_id_lock:
+        # Another worker process may have issued ids since, including ids of writes that failed
+        # and were never replayed here
+        persisted = read_annotation_sequence()
+        for m, number in persisted.items():
+            if number > annotation_id_sequence.get(m, -1):
+                annotation_id_sequence[m] = number
+        annotation_id_sequence[manuscript_id] = annotation_id_sequence.get(manuscript_id, -1) + 1
+        with open(annotation_sequence_file, 'w', encoding='utf-8') as f:
+            json.dump(annotation_id_sequence, f)
+        return str(annotation_id_sequence[manuscript_id])
+
+
+for m_id, manuscript_annotations in annotations.items():
+    index_verse_annotations(m_id, manuscript_annotations)
+    duplicate_index.build(m_id, manuscript_annotations)
+    # Resolve the stored annotations to the word positions they cover
+    token_index.build_annotations(m_id, manuscript_annotations)
+    build_annotation_counts(m_id, manuscript_annotations)
+    highest_id = pd.to_numeric(manuscript_annotations['annotation_id'], errors='coerce').max()
+    if pd.notna(highest_id):
+        note_annotation_id(m_id, int(highest_id))
+
+
+# Change feed: every write route appends an entry with a global, monotonically increasing sequence
+# number. Entries are persisted to changes.ndjson so the sequence survives restarts and the most
+# recent ones are kept in memory to answer delta requests and feed the event stream.
+changes_file = os.path.join(resources_directory, "changes.ndjson")
+max_retained_changes = 10000
+change_log = deque(maxlen=max_retained_changes)
+change_seq = 0
+change_condition = threading.Condition()
+# Bytes of changes_file this process has already read
+change_log_offset = 0
+sync_lock = threading.RLock()
+
+
+def read_new_changes():
+    """Parse the complete entries appended to changes_file since this process last read it"""
+    global change_log_offset
+    if not os.path.exists(changes_file):
+        return []
+    with open(changes_file, 'rb') as f:
+        f.seek(change_log_offset)
+        data = f.read()
+    # A line without its newline is still being written by another process
+    complete = data[:data.rfind(b'\n') + 1]
+    change_log_offset += len(complete)
+    changes = []
+    for line in complete.splitlines():
+        try:
+            changes.append(json.loads(line))
+        except ValueError:
+            continue
+    return changes
+
+
+@contextmanager
+def change_log_lock():
+    """Hold the change log exclusively, across threads and (where flock exists) worker processes"""
+    with sync_lock:
+        with open(changes_file, 'ab') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_change_log():
+    """
+    Restore the latest sequence number and the retained tail of the change log from disk. Older
+    entries can no longer be served (clients that far behind get a reset), so the file is
+    compacted to the retained tail, which keeps it from growing across restarts.
+    """
+    global change_seq, change_log_offset
+    if not os.path.exists(changes_file):
+        return
+    with change_log_lock():
+        tail = deque(maxlen=max_retained_changes)
+        dropped = 0
+        with open(changes_file, 'rb') as f:
+            for line in f:
+                if len(tail) == max_retained_changes or not line.endswith(b'\n'):
+                    # Either pushed out of the tail or an entry cut short by a crash
+                    dropped += 1
+                if line.endswith(b'\n'):
+                    tail.append(line)
+        if dropped:
+            compacted = changes_file + '.tmp'
+            with open(compacted, 'wb') as f:
+                f.writelines(tail)
+            os.replace(compacted, changes_file)
+        change_log_offset = sum(len(line) for line in tail)
+        for line in tail:
+            try:
+                change = json.loads(line)
+            except ValueError:
+                continue
+            change_log.append(change)
+            change_seq = max(change_seq, change['seq'])
+
+
+load_change_log()
+
+
+def record_change(entity, op, key, data=None, manuscript_id=None):
+    """Append an insert/update/delete of an annotation or template to the change feed"""
+    global change_seq, change_log_offset
+    with change_log_lock() as f:
+        # Another worker may have appended since our last sync; take its sequence numbers into account
+        sync_changes()
+        with change_condition:
+            change_seq += 1
+            change = {
+                'seq': change_seq,
+                'entity': entity,
+                'op': op,
+                'manuscript_id': manuscript_id,
+                'id': key,
+                'data': data,
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            line = (json.dumps(change, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+            f.write(line)
+            f.flush()
+            change_log_offset += len(line)
+            change_log.append(change)
+            change_condition.notify_all()
+    return change_seq
+
+
+def sync_changes():
+    """Replay the changes other worker processes appended to the change log on this process's state"""
+    global change_seq
+    with sync_lock:
+        changes = read_new_changes()
+        if not changes:
+            return
+        with change_condition:
+            for change in changes:
+                if change['seq'] <= change_seq:
+                    continue
+                apply_change(change)
+                change_log.append(change)
+                change_seq = change['seq']
+            change_condition.notify_all()
+
+
+def apply_change(change):
+    """Apply a change recorded by another process to the in-memory annotations and templates"""
+    data = dict(change.get('data') or {})
+    if change['entity'] == 'annotation':
+        manuscript_id = change['manuscript_id']
+        if manuscript_id not in annotations:
+            return
+        if change['op'] == 'insert':
+            append_annotation(manuscript_id, data)
+        elif change['op'] == 'update':
+            update_annotation_rows(manuscript_id, data)
+        elif change['op'] == 'delete':
+            delete_annotation_rows(manuscript_id, change['id'])
+    elif change['entity'] == 'template':
+        if change['op'] == 'insert':
+            template_repository.add(data, persist=False)
+        elif change['op'] == 'update':
+            template_repository.update(change['id'], data)
+
+
+# Set by serve.py when several forked worker processes serve the app. Each worker then replays the
+# others' writes from the change log before handling a request.
+shared_state = False
+# Write routes run one at a time - across the threads of a process always, and across processes
+# too in shared mode - so every workbook written includes all earlier writes.
+write_endpoints = {'save_annotation', 'delete_annotation', 'update_annotation', 'save_annotations',
+                   'save_template', 'increment_template_popularity', 'get_next_template_id'}
+write_lock_file = os.path.join(resources_directory, ".write.lock")
+write_thread_lock = threading.Lock()
+
+
+def enable_shared_state():
+    global shared_state
+    shared_state = True
+
+
+@app.before_request
+def sync_shared_state():
+    if request.endpoint in write_endpoints:
+        write_thread_lock.acquire()
+        lock = None
+        try:
+            if shared_state:
+                lock = open(write_lock_file, 'a')
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+        except BaseException:
+            if lock is not None:
+                lock.close()
+            write_thread_lock.release()
+            raise
+        # Only set once the locks are held; release_write_lock gives them back
+        g.write_locked = True
+        g.write_lock = lock
+    if shared_state:
+        sync_changes()
+
+
+@app.teardown_request
+def release_write_lock(exc):
+    if not g.pop('write_locked', False):
+        return
+    lock = g.pop('write_lock', None)
+    if lock is not None:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    write_thread_lock.release()
+
+
+def changes_since(since):
+    """
+    Return (reset, changes) for everything recorded after `since`. `reset` is True when the
+    client is too far behind (or ahead, after a log reset) and has to reload from scratch.
+    Must be called while holding change_condition.
+    """
+    oldest = change_log[0]['seq'] if change_log else change_seq + 1
+    if since > change_seq or since < oldest - 1:
+        return True, []
+    newer = []
+    for change in reversed(change_log):
+        if change['seq'] <= since:
+            break
+        newer.append(change)
+    newer.reverse()
+    return False, newer
 
 
 def starts_with_arabic(text):
@@ -138,60 +759,41 @@ def starts_with_arabic(text):
 
 @app.route('/search_verse', methods=['GET'])
 def search():
+    """
+    Search verses by AyahKey prefix, page/juz/sura selector, sura name and Arabic text, in any
+    combination (e.g. "2:25 جنات", "p:3 الله", "sura:baqarah", "سورة البقرة"); see verse_query.py
+    """
     query = request.args.get('query', '')
-    if query[0].isdigit():
-        verse_results = df_verses[df_verses['AyahKey'].str.startswith(query, na=False)].to_dict(orient='records')
-    else:  # starts_with_arabic(query):
-        verse_results = df_verses[df_verses['searchable_text'].str.contains(query, na=False)].to_dict(orient='records')
-    # else:
-    #     verse_results = df_verses[df_verses['EnglishTranslation'].str.contains(query, na=False)].to_dict(
-    #         orient='records')
-
-    results = verse_results
+    positions = execute_verse_plan(plan_verse_query(query.strip()))
 
-    return jsonify(results)
+    # The verse records are serialized once in the store, results are assembled from those bytes
+    return Response(verse_store.records_json(positions), mimetype='application/json')
 
 
 @app.route('/selectNextVerse', methods=['GET'])
 def selectNextVerse():
     query = request.args.get('current', '')
-    filtered_df = df_verses[df_verses['AyahKey'] == query]
+    target_index = verse_store.position(query)
 
-    if filtered_df.empty or len(filtered_df) > 1:
+    # If it's the last row or an unknown verse, return None
+    if target_index is None or target_index == verse_store.size - 1:
         return jsonify(None)
 
-    # Get the index of the first row where the condition is met
-    target_index = filtered_df.index[0]
-
-    # If it's the first row, return a message or None
-    if target_index == len(df_verses) - 1:
-        return jsonify(None)
-    else:
-        # Return the previous row
-        results = df_verses.iloc[target_index + 1].to_dict()
-
-    return jsonify(results)
+    # Return the next row
+    return Response(verse_store.record_json(target_index + 1), mimetype='application/json')
 
 
 @app.route('/selectPreviousVerse', methods=['GET'])
 def selectPreviousVerse():
     query = request.args.get('current', '')
-    filtered_df = df_verses[df_verses['AyahKey'] == query]
+    target_index = verse_store.position(query)
 
-    if filtered_df.empty or len(filtered_df) > 1:
+    # If it's the first row or an unknown verse, return None
+    if target_index is None or target_index == 0:
         return jsonify(None)
 
-    # Get the index of the first row where the condition is met
-    target_index = filtered_df.index[0]
-
-    # If it's the first row, return a message or None
-    if target_index == 0:
-        return jsonify(None)
-    else:
-        # Return the previous row
-        results = df_verses.iloc[target_index - 1].to_dict()
-
-    return jsonify(results)
+    # Return the previous row
+    return Response(verse_store.record_json(target_index - 1), mimetype='application/json')
 
 
 @app.route('/get_annotations', methods=['GET'])
@@ -199,9 +801,8 @@ def get_annotations():
     query = request.args.get('query', '')
 
     results = []
-    for manuscript_id, annotations_list in annotations.items():
-        annotations_list = annotations_list.to_dict(orient='records')
-        manuscript_annotations = [a for a in annotations_list if a['verse_id'] == query]
+    for manuscript_id in annotations.keys():
+        manuscript_annotations = verse_annotations.get(manuscript_id, {}).get(query, [])
 
         results.append({
             'manuscript_name': f"Manuscript {manuscript_id}",
@@ -212,6 +813,141 @@ def get_annotations():
     return results
 
 
+def annotations_by_verse(manuscript_id, verse_keys):
+    """A manuscript's annotations on the given verses by verse_id, read from the verse index"""
+    verses = verse_annotations.get(manuscript_id, {})
+    return {verse_key: verses[verse_key] for verse_key in verse_keys if verse_key in verses}
+
+
+def selected_verse_positions(args):
+    """
+    Row positions of df_verses selected by page/sura/juz ranges, an AyahKey range (verse=2:1-2:10)
+    and a lines range within them. Returns (positions, error); positions is None without a selector.
+    """
+    positions = None
+    for param, column in verse_range_columns.items():
+        value = args.get(param, '')
+        if value == '':
+            continue
+        bounds = parse_range(value)
+        if bounds is None:
+            return None, f"Invalid {param} range"
+        selected = verse_positions_in_range(column, *bounds)
+        positions = selected if positions is None else np.intersect1d(positions, selected)
+
+    verse = args.get('verse', '')
+    if verse != '':
+        bounds = [verse_store.position(key.strip()) for key in verse.split('-', 1)]
+        if None in bounds:
+            return None, "Invalid verse range"
+        selected = np.arange(min(bounds), max(bounds) + 1)
+        positions = selected if positions is None else np.intersect1d(positions, selected)
+
+    lines = args.get('lines', '')
+    if lines != '' and positions is not None:
+        bounds = parse_range(lines)
+        if bounds is None:
+            return None, "Invalid lines range"
+        # A verse overlaps the lines if it starts before the last one and ends after the first one
+        starts_before = verse_positions_in_range('line_start', -np.inf, bounds[1])
+        ends_after = verse_positions_in_range('line_end', bounds[0], np.inf)
+        positions = np.intersect1d(positions, np.intersect1d(starts_before, ends_after))
+    return positions, None
+
+
+def requested_manuscripts(args):
+    """Manuscript ids from ?manuscripts=a,b (all of them when absent) and the unknown ones"""
+    manuscript_ids = [m for value in args.getlist('manuscripts') for m in value.split(',') if m]
+    if not manuscript_ids:
+        manuscript_ids = list(annotations.keys())
+    return manuscript_ids, [m for m in manuscript_ids if m not in annotations]
+
+
+def json_object(serialized, fields):
+    """
+    JSON object bytes from members that are already serialized (name -> JSON bytes, e.g. stored
+    verse records) and members still to be serialized
+    """
+    members = [json.dumps(name).encode('utf-8') + b':' + value for name, value in serialized.items()]
+    if fields:
+        members.append(app.json.dumps(fields)[1:-1].encode('utf-8'))
+    return b'{' + b','.join(members) + b'}'
+
+
+def verse_json(position, fields):
+    """The stored JSON of a verse with `fields` added to the object"""
+    record = verse_store.record_json(position)
+    return record[:-1] + b',' + app.json.dumps(fields)[1:-1].encode('utf-8') + b'}'
+
+
+@app.route('/get_verse_range', methods=['GET'])
+def get_verse_range():
+    """
+    Return all verses of a page, sura, juz or verse range (e.g. ?page=3-4, ?sura=2, ?juz=30,
+    ?verse=2:1-2:10) with the annotations of each manuscript joined per verse. `lines` narrows the range to the verses
+    overlapping those mushaf lines and `manuscripts` (comma separated) restricts the join.
+    """
+    positions, error = selected_verse_positions(request.args)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    if positions is None:
+        return jsonify({"error": "A page, sura or juz range is required"}), 400
+
+    manuscript_ids, unknown = requested_manuscripts(request.args)
+    if unknown:
+        return jsonify({"error": f"Unknown manuscripts: {', '.join(unknown)}"}), 400
+
+    verse_keys = [verse_store.key(p) for p in positions]
+    joined = {m: annotations_by_verse(m, verse_keys) for m in manuscript_ids}
+
+    results = [verse_json(position, {'annotations': [{
+        'manuscript_name': f"Manuscript {manuscript_id}",
+        'manuscript_id': manuscript_id,
+        'annotations': joined[manuscript_id].get(verse_key, [])
+    } for manuscript_id in manuscript_ids]}) for position, verse_key in zip(positions, verse_keys)]
+
+    return Response(b'[' + b','.join(results) + b']', mimetype='application/json')
+
+
+@app.route('/get_verse_bundle', methods=['GET'])
+def get_verse_bundle():
+    """
+    Everything the editor needs to open a verse in one response: the verse and its neighbours,
+    every (or the selected) manuscript's annotations on it, each manuscript's languages and
+    annotation types, and the most popular templates (?verse=2:25&manuscripts=Konduga,YM).
+    """
+    verse_key = request.args.get('verse', '')
+    position = verse_store.position(verse_key)
+    if position is None:
+        return jsonify({"error": "Verse not found"}), 404
+
+    manuscript_ids, unknown = requested_manuscripts(request.args)
+    if unknown:
+        return jsonify({"error": f"Unknown manuscripts: {', '.join(unknown)}"}), 400
+
+    def verse_record(p):
+        return verse_store.record_json(p) if 0 <= p < verse_store.size else b'null'
+
+    # The verses are spliced in from their stored serializations; everything else comes from the
+    # verse index, the vocabulary counts and the repository's popularity order
+    return Response(json_object({
+        'verse': verse_record(position),
+        'previous': verse_record(position - 1),
+        'next': verse_record(position + 1),
+    }, {
+        'annotations': [{
+            'manuscript_name': f"Manuscript {manuscript_id}",
+            'manuscript_id': manuscript_id,
+            'annotations': verse_annotations.get(manuscript_id, {}).get(verse_key, [])
+        } for manuscript_id in manuscript_ids],
+        'vocabularies': {
+            manuscript_id: {name: vocabulary(manuscript_id, column) for column, name in vocabulary_columns.items()}
+            for manuscript_id in manuscript_ids
+        },
+        'templates': popular_template_suggestions(10),
+    }), mimetype='application/json')
+
+
 @app.route('/get_manuscripts', methods=['GET'])
 def get_manuscripts():
     results = []
@@ -229,7 +965,7 @@ def get_languages():
     m = request.args.get("manuscript", "")
     results = []
     if m != "":
-        results = annotations[m]['annotation_Language'].unique().tolist()
+        results = vocabulary(m, 'annotation_Language')
         # print(sorted(results))
     return results
 
@@ -239,7 +975,7 @@ def get_annotation_types():
     m = request.args.get("manuscript", "")
     results = []
     if m != "":
-        results = annotations[m]['annotation_type'].unique().tolist()
+        results = vocabulary(m, 'annotation_type')
         # print(sorted(results))
     return results
 
@@ -251,10 +987,19 @@ def save_annotation():
         # Process the annotation data here
         # For example, save it to a database
         manus_id = data["manuscript_id"]
-        data['annotation_id'] = f"{len(annotations[manus_id])}"
-        df_dictionary = pd.DataFrame([data])
-        annotations[manus_id] = pd.concat([annotations[manus_id], df_dictionary], ignore_index=True)
-        annotations[manus_id].to_excel(os.path.join(resources_directory, f'{manus_id}.xlsx'), index=False)
+        # Re-entering the same gloss on the same word returns the existing annotation unless forced
+        allow_duplicate = normalize_flag(data.pop('allow_duplicate', False))
+        warning = duplicate_warning(manus_id, data)
+        if warning is not None and not allow_duplicate:
+            return jsonify({"message": "Annotation already exists", "duplicate": True,
+                            "annotation": warning['duplicate_of']}), 200
+        data['annotation_id'] = next_annotation_id(manus_id)
+        if warning is not None:
+            warning['annotation_id'] = data['annotation_id']
+        append_annotation(manus_id, data, persist=True)
+        record_change('annotation', 'insert', data['annotation_id'], data, manus_id)
+        if warning is not None:
+            return jsonify({"message": "Annotation saved successfully", "warnings": [warning]}), 200
         return jsonify({"message": "Annotation saved successfully"}), 200
     except Exception as e:
         return jsonify({"error": "An error occurred while saving the item"}), 500
@@ -265,8 +1010,8 @@ def delete_annotation():
     a_id = request.args.get("a_id", "")
     m_id = request.args.get("m_id", "")
     try:
-        annotations[m_id] = annotations[m_id][annotations[m_id]['annotation_id'] != a_id]
-        annotations[m_id].to_excel(os.path.join(resources_directory, f'{m_id}.xlsx'), index=False)
+        delete_annotation_rows(m_id, a_id, persist=True)
+        record_change('annotation', 'delete', a_id, manuscript_id=m_id)
         return jsonify({"message": "Item deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": "An error occurred while deleting the item"}), 500
@@ -276,14 +1021,12 @@ def delete_annotation():
 def update_annotation():
     try:
         data = request.json
-        keys = []
-        values = []
-        for k, v in data.items():
-            keys.append(k)
-            values.append(v)
         manus_id = data["manuscript_id"]
-        annotations[manus_id].loc[annotations[manus_id]['annotation_id'] == data['annotation_id'], keys] = values
-        annotations[manus_id].to_excel(os.path.join(resources_directory, f'{manus_id}.xlsx'), index=False)
+        updated = update_annotation_rows(manus_id, data, persist=True)
+        record_change('annotation', 'update', data['annotation_id'], data, manus_id)
+        warnings = [w for w in (duplicate_warning(manus_id, row, row['annotation_id']) for row in updated) if w]
+        if warnings:
+            return jsonify({"message": "Annotation saved successfully", "warnings": warnings}), 200
         return jsonify({"message": "Annotation saved successfully"}), 200
     except Exception as e:
         return jsonify({"error": f"{e}"}), 500
@@ -292,80 +1035,82 @@ def update_annotation():
 @app.route('/save_annotations', methods=['POST'])
 def save_annotations():
     updatedAndDeleted = request.json
+    updated = []
     for data in updatedAndDeleted['updatedRows']:
-        keys = []
-        values = []
-        for k, v in data.items():
-            keys.append(k)
-            values.append(v)
         manus_id = data["manuscript_id"]
-        annotations[manus_id].loc[annotations[manus_id]['annotation_id'] == data['annotation_id'], keys] = values
-        annotations[manus_id].to_excel(os.path.join(resources_directory, f'{manus_id}.xlsx'), index=False)
+        updated.extend((manus_id, row) for row in update_annotation_rows(manus_id, data, persist=True))
+        record_change('annotation', 'update', data['annotation_id'], data, manus_id)
 
     for data in updatedAndDeleted['deletedRows']:
         a_id = data['annotation_id']
         m_id = data['manuscript_id']
-        annotations[m_id] = annotations[m_id][annotations[m_id]['annotation_id'] != a_id]
-        annotations[m_id].to_excel(os.path.join(resources_directory, f'{m_id}.xlsx'), index=False)
+        delete_annotation_rows(m_id, a_id, persist=True)
+        record_change('annotation', 'delete', a_id, manuscript_id=m_id)
 
+    # Duplicates are reported once all edits are applied, but the edits are kept
+    warnings = [w for w in (duplicate_warning(m_id, row, row['annotation_id']) for m_id, row in updated) if w]
+    if warnings:
+        return {'message': 'Annotations updated successfully', 'warnings': warnings}, 200
     return {'message': 'Annotations updated successfully'}, 200
 
 
+def active_filters(filters):
+    """
+    The filters of a filter spec that have a value. Returns (filters, error); the spec has to be
+    a JSON object of column -> {"value": ..., "matchType": ...} objects.
+    """
+    if filters is None:
+        return {}, None
+    if not isinstance(filters, dict) or not all(isinstance(f, dict) for f in filters.values()):
+        return None, "Filters must be an object of column filters"
+    return {key: f for key, f in filters.items() if "value" in f and f['value'] != ""}, None
+
+
+def filtered_annotation_frames(filters):
+    """
+    Yield (manuscript_id, table, positions of the matching rows) for every manuscript, using one
+    boolean mask per manuscript. Callers take the rows they need with iloc, so no copy of all
+    matching rows is made.
+    """
+    for manuscript_id, annotations_list in list(annotations.items()):
+        match = np.ones(len(annotations_list), dtype=bool)
+        for key, filter_data in filters.items():
+            if key not in annotations_list.columns:
+                match[:] = False
+                break
+
+            # Extract value and match type (optional)
+            value = filter_data.get('value', '')
+            match_type = filter_data.get('matchType', 'full')  # Default to 'partial'
+
+            # Handle `flag` and `Id` filters (exact match only)
+            if key in ['flag', 'annotation_id', 'manuscript_id', 'verse_id']:
+                # If `value` is a boolean or ID, perform exact match
+                match &= matching_rows(annotations_list[key], value)
+            # Handle string-based filters (full or partial match)
+            elif isinstance(value, str) and value != "":
+                if match_type == 'full':
+                    # Perform a full case-insensitive match
+                    match &= matching_rows(annotations_list[key], value)
+                elif match_type == 'partial':
+                    # Perform a partial case-insensitive match
+                    match &= matching_rows(annotations_list[key], value, partial=True)
+
+        yield manuscript_id, annotations_list, np.flatnonzero(match)
+
+
 @app.route('/filter_annotations', methods=['POST'])
 def filter_annotations():
-    filters = request.json
-    filters_updated = filters.copy()
-    for filter_key, filter in filters.items():
-        if "value" in filter and filter['value'] == "" or "value" not in filter:
-            del filters_updated[filter_key]
-
-    filters = filters_updated
+    filters, error = active_filters(request.get_json(silent=True))
+    if error is not None:
+        return jsonify({'error': error}), 400
     if not filters:
         return jsonify({'error': 'No filters provided'}), 400
 
     # A list to hold the filtered annotations
     filtered_annotations = []
-
-    for manuscript_id, annotations_list in annotations.items():
-        # Convert the DataFrame of annotations to a list of dictionaries
-        annotations_data = annotations_list.to_dict(orient='records')
-
-        # Filter the annotations for this manuscript based on the provided filters
-        for annotation in annotations_data:
-            # Check each filter condition
-            match = True
-            for key, filter_data in filters.items():
-                if key not in annotation:
-                    match = False
-                    break
-
-                # Extract value and match type (optional)
-                value = filter_data.get('value', '')
-                match_type = filter_data.get('matchType', 'full')  # Default to 'partial'
-
-                # Handle `flag` and `Id` filters (exact match only)
-                if key in ['flag', 'annotation_id', 'manuscript_id', 'verse_id']:
-                    # If `value` is a boolean or ID, perform exact match
-                    if str(annotation[key]).lower() != str(value).lower():
-                        match = False
-                        break
-                else:
-                    # Handle string-based filters (full or partial match)
-                    if isinstance(value, str) and value != "":
-                        if match_type == 'full':
-                            # Perform a full case-insensitive match
-                            if str(annotation[key]).lower() != str(value).lower():
-                                match = False
-                                break
-                        elif match_type == 'partial':
-                            # Perform a partial case-insensitive match
-                            if str(value).lower() not in str(annotation[key]).lower():
-                                match = False
-                                break
-
-            # Add to the filtered list if all conditions match
-            if match:
-                filtered_annotations.append(annotation)
+    for manuscript_id, annotations_list, positions in filtered_annotation_frames(filters):
+        filtered_annotations.extend(annotations_list.iloc[positions].to_dict(orient='records'))
 
     return jsonify(filtered_annotations)
 
@@ -399,56 +1144,103 @@ def filter_annotations():
     #         })
     #
     # return jsonify(filtered_results)
-# Add these functions to your existing Flask server code
 
-# Global dictionary to store templates in memory
-saved_templates = pd.DataFrame()
 
-def load_saved_templates():
-    """Load all saved templates from a single Excel file into memory"""
-    global saved_templates
-    template_file = os.path.join(resources_directory, "saved_templates.xlsx")
-    if os.path.exists(template_file):
-        try:
-            saved_templates = pd.read_excel(template_file, dtype={
-                "template_id": str,
-                "template_name": str,
-                "manuscript_id": str,
-                "annotation": str,
-                "annotation_Language": str,
-                "annotation_transliteration": str,
-                "annotation_type": str,
-                "other": str,
-                "created_date": str,
-                "popularity": int
-            })
-            saved_templates = saved_templates.fillna('')
-            # Ensure popularity column exists and has default values
-            if 'popularity' not in saved_templates.columns:
-                saved_templates['popularity'] = 1
-            else:
-                # Convert popularity to int and handle NaN values
-                saved_templates['popularity'] = saved_templates['popularity'].fillna(1).astype(int)
-        except Exception as e:
-            print(f"Error loading templates: {e}")
-            saved_templates = pd.DataFrame(columns=[
-                "template_id", "template_name", "manuscript_id", "annotation", "annotation_Language",
-                "annotation_transliteration", "annotation_type", "other", "created_date", "popularity"
-            ])
-    else:
-        # Create empty template DataFrame
-        saved_templates = pd.DataFrame(columns=[
-            "template_id", "template_name", "manuscript_id", "annotation", "annotation_Language",
-            "annotation_transliteration", "annotation_type", "other", "created_date", "popularity"
-        ])
+# Rows are converted and written out this many at a time while exporting
+export_chunk_size = 1000
+export_formats = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+
+def export_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def export_rows(filters):
+    """Yield chunks of matching annotations as lists of rows ordered like annotation_columns"""
+    for _, annotations_list, positions in filtered_annotation_frames(filters):
+        # Only one chunk of rows is copied out of the table at a time
+        for start in range(0, len(positions), export_chunk_size):
+            chunk = annotations_list.iloc[positions[start:start + export_chunk_size]].reindex(columns=annotation_columns)
+            yield [[export_value(v) for v in row] for row in chunk.itertuples(index=False, name=None)]
+
+
+def export_csv(filters):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(annotation_columns)
+    for rows in export_rows(filters):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def export_ndjson(filters):
+    for rows in export_rows(filters):
+        yield ''.join(json.dumps(dict(zip(annotation_columns, row)), ensure_ascii=False, default=str) + '\n'
+                      for row in rows).encode('utf-8')
+
+
+def export_xlsx(filters):
+    # Rows go through openpyxl's write-only mode, which streams them to temporary files instead of
+    # keeping cells in memory. An xlsx is a zip archive, so it can only be sent once it is closed.
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("annotations")
+    sheet.append(annotation_columns)
+    for rows in export_rows(filters):
+        for row in rows:
+            # Control characters cannot be stored in a worksheet; openpyxl would fail mid-stream
+            sheet.append([ILLEGAL_CHARACTERS_RE.sub('', v) if isinstance(v, str) else v for v in row])
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            data = output.read(64 * 1024)
+            if not data:
+                break
+            yield data
+
+
+@app.route('/export_annotations', methods=['POST'])
+def export_annotations():
+    """
+    Stream the annotations matching a /filter_annotations filter spec as ?format=csv, ndjson or
+    xlsx. Unlike /filter_annotations an empty filter spec exports every annotation.
+    """
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in export_formats:
+        return jsonify({'error': f"Unsupported export format: {export_format}"}), 400
+    filters, error = active_filters(request.get_json(silent=True))
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    generators = {'csv': export_csv, 'ndjson': export_ndjson, 'xlsx': export_xlsx}
+    mimetype, extension = export_formats[export_format]
+    return Response(generators[export_format](filters), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=annotations.{extension}'})
+
+
+# Add these functions to your existing Flask server code
+
+# Templates are held by a repository with hash indexes on template_id and on the template fields
+template_repository = TemplateRepository(os.path.join(resources_directory, "saved_templates.xlsx"),
+                                         os.path.join(resources_directory, "template_id_sequence.txt"))
 
 # Load templates when server starts
-load_saved_templates()
+template_repository.load()
 
 @app.route('/increment_template_popularity', methods=['POST'])
 def increment_template_popularity():
     """Increment the popularity counter for a specific template"""
-    global saved_templates
     try:
         data = request.json
         template_id = data.get('template_id', '').strip()
@@ -456,21 +1248,13 @@ def increment_template_popularity():
         if not template_id:
             return jsonify({"error": "Template ID is required"}), 400
 
-        # Find the template by ID
-        template_mask = saved_templates['template_id'] == template_id
+        # Increment popularity and save the updated templates to Excel file
+        updated_popularity = template_repository.increment_popularity(template_id)
 
-        if not template_mask.any():
+        if updated_popularity is None:
             return jsonify({"error": "Template not found"}), 404
 
-        # Increment popularity
-        saved_templates.loc[template_mask, 'popularity'] = saved_templates.loc[template_mask, 'popularity'] + 1
-
-        # Save the updated templates to Excel file
-        template_file = os.path.join(resources_directory, "saved_templates.xlsx")
-        saved_templates.to_excel(template_file, index=False)
-
-        # Get the updated popularity value for confirmation
-        updated_popularity = saved_templates.loc[template_mask, 'popularity'].iloc[0]
+        record_change('template', 'update', template_id, {'popularity': int(updated_popularity)})
 
         return jsonify({
             "message": "Template popularity incremented successfully",
@@ -525,6 +1309,63 @@ def get_attribute_suggestions():
         print(f"Error in get_attribute_suggestions: {e}")
         return jsonify([])
 
+def template_display_text(row):
+    """template_name if available, otherwise the non-empty template fields joined with '-'"""
+    if row.get('template_name') and str(row['template_name']).strip():
+        return str(row['template_name']).strip()
+    display_parts = []
+    for field in template_fields:
+        value = str(row[field]).strip() if pd.notna(row[field]) else ''
+        if value and value != 'nan':
+            # Truncate long values for display
+            if len(value) > 20:
+                value = value[:17] + "..."
+            display_parts.append(value)
+    return '-'.join(display_parts)
+
+
+def template_suggestion(row, index):
+    return {
+        'id': str(row.get('template_id', index)),
+        'annotation': str(row['annotation']) if pd.notna(row['annotation']) else '',
+        'annotation_Language': str(row['annotation_Language']) if pd.notna(row['annotation_Language']) else '',
+        'annotation_transliteration': str(row['annotation_transliteration']) if pd.notna(row['annotation_transliteration']) else '',
+        'annotation_type': str(row['annotation_type']) if pd.notna(row['annotation_type']) else '',
+        'other': str(row['other']) if pd.notna(row['other']) else '',
+        'displayText': template_display_text(row)
+    }
+
+
+def unique_suggestions(suggestions):
+    """Drop suggestions repeating the combination of all template fields of an earlier one"""
+    seen_combinations = set()
+    unique = []
+    for suggestion in suggestions:
+        combination = tuple(suggestion[field] for field in template_fields)
+        if combination not in seen_combinations:
+            seen_combinations.add(combination)
+            unique.append(suggestion)
+    return unique
+
+
+def popular_template_suggestions(limit=10):
+    """The most popular saved templates, as suggestions"""
+    # The repository keeps the templates sorted by popularity; only the top ones are converted
+    suggestions = []
+    seen_combinations = set()
+    for row in template_repository.popular():
+        suggestion = template_suggestion(row, len(suggestions))
+        combination = tuple(suggestion[field] for field in template_fields)
+        if combination in seen_combinations:
+            continue
+        seen_combinations.add(combination)
+        suggestion['popularity'] = int(row['popularity']) if pd.notna(row['popularity']) else 0
+        suggestions.append(suggestion)
+        if len(suggestions) == limit:
+            break
+    return suggestions
+
+
 @app.route('/get_template_suggestions', methods=['GET'])
 def get_template_suggestions():
     manuscript_id = request.args.get('manuscript', '')
@@ -532,72 +1373,15 @@ def get_template_suggestions():
     recent = request.args.get('recent', '')
 
     try:
-        # Template fields
-        template_fields = ['annotation', 'annotation_Language', 'annotation_transliteration', 'annotation_type', 'other']
-
         # Get all saved templates (global across all manuscripts)
-        if saved_templates.empty:
+        saved_templates = template_repository.rows()
+        if not saved_templates:
             return jsonify([])
 
         # Handle recent parameter - when true, sort by popularity and ignore query
         if recent.lower() == 'true':
-            # Sort by popularity column (highest first)
-            if 'popularity' not in saved_templates.columns:
-                print("Warning: 'popularity' column not found in saved_templates")
-                return jsonify([])
-
-            # Sort by popularity descending (highest popularity first)
-            sorted_templates = saved_templates.sort_values('popularity', ascending=False)
-
-            # Create suggestions from sorted templates
-            suggestions = []
-            for _, row in sorted_templates.iterrows():
-                # Use template_name if available, otherwise create display text from fields
-                if row.get('template_name') and str(row['template_name']).strip():
-                    display_text = str(row['template_name']).strip()
-                else:
-                    # Create display text in format: "annotation-language-transliteration-type-other"
-                    display_parts = []
-                    for field in template_fields:
-                        value = str(row[field]).strip() if pd.notna(row[field]) else ''
-                        if value and value != 'nan':
-                            # Truncate long values for display
-                            if len(value) > 20:
-                                value = value[:17] + "..."
-                            display_parts.append(value)
-                        else:
-                            display_parts.append('')
-                    display_text = '-'.join(filter(None, display_parts))  # Filter out empty parts
-
-                template = {
-                    'id': str(row.get('template_id', len(suggestions))),
-                    'annotation': str(row['annotation']) if pd.notna(row['annotation']) else '',
-                    'annotation_Language': str(row['annotation_Language']) if pd.notna(row['annotation_Language']) else '',
-                    'annotation_transliteration': str(row['annotation_transliteration']) if pd.notna(row['annotation_transliteration']) else '',
-                    'annotation_type': str(row['annotation_type']) if pd.notna(row['annotation_type']) else '',
-                    'other': str(row['other']) if pd.notna(row['other']) else '',
-                    'displayText': display_text,
-                    'popularity': int(row['popularity']) if pd.notna(row['popularity']) else 0
-                }
-                suggestions.append(template)
-
-            # Remove duplicates based on the combination of all template fields
-            seen_combinations = set()
-            unique_suggestions = []
-            for suggestion in suggestions:
-                combination = (
-                    suggestion['annotation'],
-                    suggestion['annotation_Language'],
-                    suggestion['annotation_transliteration'],
-                    suggestion['annotation_type'],
-                    suggestion['other']
-                )
-                if combination not in seen_combinations:
-                    seen_combinations.add(combination)
-                    unique_suggestions.append(suggestion)
-
             # Return top 10 most recent suggestions
-            return jsonify(unique_suggestions[:10])
+            return jsonify(popular_template_suggestions(10))
 
         # Original query-based logic when recent is not true
         if not query:
@@ -605,57 +1389,20 @@ def get_template_suggestions():
 
         # Create template suggestions based on query
         suggestions = []
-        for _, row in saved_templates.iterrows():
-            # Use template_name if available, otherwise create display text from fields
-            if row.get('template_name') and str(row['template_name']).strip():
-                display_text = str(row['template_name']).strip()
-            else:
-                # Create display text in format: "annotation-language-transliteration-type-other"
-                display_parts = []
-                for field in template_fields:
-                    value = str(row[field]).strip() if pd.notna(row[field]) else ''
-                    if value and value != 'nan':
-                        # Truncate long values for display
-                        if len(value) > 20:
-                            value = value[:17] + "..."
-                        display_parts.append(value)
-                    else:
-                        display_parts.append('')
-                display_text = '-'.join(filter(None, display_parts))  # Filter out empty parts
+        for row in saved_templates:
+            suggestion = template_suggestion(row, len(suggestions))
 
             # Check if query matches any part of the display text or template fields (case-insensitive)
-            searchable_text = display_text.lower()
+            searchable_text = suggestion['displayText'].lower()
             field_text = ' '.join([
                 str(row[field]).lower() if pd.notna(row[field]) else ''
                 for field in template_fields
             ])
 
             if query.lower() in searchable_text or query.lower() in field_text:
-                template = {
-                    'id': str(row.get('template_id', len(suggestions))),
-                    'annotation': str(row['annotation']) if pd.notna(row['annotation']) else '',
-                    'annotation_Language': str(row['annotation_Language']) if pd.notna(row['annotation_Language']) else '',
-                    'annotation_transliteration': str(row['annotation_transliteration']) if pd.notna(row['annotation_transliteration']) else '',
-                    'annotation_type': str(row['annotation_type']) if pd.notna(row['annotation_type']) else '',
-                    'other': str(row['other']) if pd.notna(row['other']) else '',
-                    'displayText': display_text
-                }
-                suggestions.append(template)
-
-        # Remove duplicates based on the combination of all template fields
-        seen_combinations = set()
-        unique_suggestions = []
-        for suggestion in suggestions:
-            combination = (
-                suggestion['annotation'],
-                suggestion['annotation_Language'],
-                suggestion['annotation_transliteration'],
-                suggestion['annotation_type'],
-                suggestion['other']
-            )
-            if combination not in seen_combinations:
-                seen_combinations.add(combination)
-                unique_suggestions.append(suggestion)
+                suggestions.append(suggestion)
+
+        suggestions = unique_suggestions(suggestions)
 
         # Sort by relevance (better matches first)
         def sort_key(item):
@@ -667,10 +1414,10 @@ def get_template_suggestions():
                 return (index, item['displayText'])
             return (999, item['displayText'])
 
-        unique_suggestions.sort(key=sort_key)
+        suggestions.sort(key=sort_key)
 
         # Limit to top 8 suggestions to avoid overwhelming the UI
-        return jsonify(unique_suggestions[:8])
+        return jsonify(suggestions[:8])
 
     except Exception as e:
         print(f"Error in get_template_suggestions: {e}")
@@ -678,7 +1425,6 @@ def get_template_suggestions():
 
 @app.route('/save_template', methods=['POST'])
 def save_template():
-    global saved_templates
     try:
         data = request.json
         manuscript_id = data.get('manuscript_id', '')
@@ -699,29 +1445,7 @@ def save_template():
         if not has_content:
             return jsonify({"error": "Template must have at least one non-empty field"}), 400
 
-        # Check if this exact template combination already exists
-        if not saved_templates.empty:
-            # Create a mask to find matching templates
-            match_conditions = []
-            for field in template_fields:
-                field_value = data.get(field, '').strip()
-                if field_value:
-                    match_conditions.append(saved_templates[field].fillna('').astype(str).str.strip() == field_value)
-                else:
-                    match_conditions.append(saved_templates[field].fillna('').astype(str).str.strip() == '')
-
-            # Combine all conditions with AND
-            if match_conditions:
-                combined_mask = match_conditions[0]
-                for condition in match_conditions[1:]:
-                    combined_mask = combined_mask & condition
-
-                # Check if any row matches all conditions
-                if combined_mask.any():
-                    return jsonify({"message": "Template already exists"}), 200
-
         # Create new template entry
-        from datetime import datetime
         template_data = {
             'template_id': template_id,
             'template_name': template_name,
@@ -735,15 +1459,15 @@ def save_template():
             'popularity': 1
         }
 
-        # Add template to saved_templates
-        df_template = pd.DataFrame([template_data])
-        saved_templates = pd.concat([saved_templates, df_template], ignore_index=True)
-
-        # Save to single Excel file for all templates
-        template_file = os.path.join(resources_directory, "saved_templates.xlsx")
-        saved_templates.to_excel(template_file, index=False)
+        # Add template unless this exact template combination already exists (hash lookup on the
+        # five fields); the repository saves the single Excel file for all templates
+        template_data, created = template_repository.add(template_data)
+        if not created:
+            return jsonify({"message": "Template already exists"}), 200
+        record_change('template', 'insert', template_data['template_id'], template_data)
 
-        return jsonify({"message": "Template saved successfully"}), 200
+        # The id differs from the requested one when that id was already in use
+        return jsonify({"message": "Template saved successfully", "template_id": template_data['template_id']}), 200
 
     except Exception as e:
         print(f"Error in save_template: {e}")
@@ -751,36 +1475,10 @@ def save_template():
 
 @app.route('/get_next_template_id', methods=['GET'])
 def get_next_template_id():
-    global saved_templates
     try:
-        if saved_templates.empty or 'template_id' not in saved_templates.columns:
-            next_id = 1
-        else:
-            # Extract numerical parts from existing template_ids
-            # Assuming template_ids are like "temp_1", "temp_2", or just "1", "2"
-            numeric_ids = []
-            for tid in saved_templates['template_id'].dropna().astype(str):
-                # Try to extract numbers, handling cases like "temp_123" or just "123"
-                try:
-                    # If it's purely numeric
-                    numeric_ids.append(int(tid))
-                except ValueError:
-                    # If it has a prefix like "temp_"
-                    if '_' in tid:
-                        try:
-                            numeric_ids.append(int(tid.split('_')[-1]))
-                        except ValueError:
-                            pass # Ignore if not a valid number after split
-
-            if numeric_ids:
-                next_id = max(numeric_ids) + 1
-            else:
-                next_id = 1
-
-        # You can format the ID as needed, e.g., "temp_1", "temp_2"
-        # For simplicity, returning just the number as a string for now,
-        # but you can add a prefix if your client expects it.
-        return jsonify({"nextId": str(next_id)}), 200
+        # Ids come from a persisted sequence, so each call reserves a fresh one
+        next_id = template_repository.next_id()
+        return jsonify({"nextId": next_id}), 200
 
     except Exception as e:
         print(f"Error in get_next_template_id: {e}")
@@ -789,26 +1487,15 @@ def get_next_template_id():
 
 @app.route('/get_template', methods=['GET'])
 def get_template():
-    global saved_templates # Ensure access to the global DataFrame
     template_id = request.args.get('id')
 
     if not template_id:
         return jsonify({"error": "Template ID is required"}), 400
 
     try:
-        # Ensure 'template_id' column is treated as string for robust comparison
-        # And handle potential NaN values by converting to string first
-        template_row = saved_templates[saved_templates['template_id'].fillna('').astype(str) == template_id]
-
-        if not template_row.empty:
-            # Convert the found row to a dictionary and return.
-            # .iloc[0] gets the first (and should be only) matching row
-            # .to_dict() converts it to a dictionary
-            # orient='records' ensures it's a list of dictionaries if multiple rows matched,
-            # but with template_id as unique, it will be a list with one dict.
-            # We take the first element [0]
-            template_data = template_row.iloc[0].to_dict()
+        template_data = template_repository.get(template_id)
 
+        if template_data is not None:
             # Clean up the data for the frontend if necessary (e.g., remove popularity, created_date)
             # Or send all, depending on what your frontend 'Template' interface expects.
             # Let's match your frontend 'Template' interface.
@@ -940,5 +1627,216 @@ def get_recent_annotations():
     all_annotations.sort(key=lambda x: int(x.get('annotation_id', 0)), reverse=True)
 
     return jsonify(all_annotations[:limit])
+
+
+@app.route('/get_memory_report', methods=['GET'])
+def get_memory_report():
+    """Memory used by each manuscript's annotation table before and after dictionary encoding"""
+    return jsonify(annotation_memory_report())
+
+
+@app.route('/get_duplicate_report', methods=['GET'])
+def get_duplicate_report():
+    """Groups of near-duplicate annotations in one manuscript (or all when none is given)"""
+    m = request.args.get("manuscript", "")
+    if m != "" and m not in annotations:
+        return jsonify({"error": "Invalid manuscript ID"}), 400
+    manuscript_ids = [m] if m != "" else list(annotations.keys())
+    report = []
+    for manuscript_id in manuscript_ids:
+        report.extend(duplicate_report(manuscript_id, annotations[manuscript_id]))
+    return jsonify(report)
+
+
+def annotation_records(references):
+    """
+    Annotation rows for (manuscript_id, annotation_id) pairs placed on words, found through the
+    verse of their word span and the verse index, in verse order
+    """
+    wanted = {}
+    for manuscript_id, annotation_id in references:
+        span = token_index.span_by_annotation.get((manuscript_id, str(annotation_id)))
+        if span is not None:
+            wanted.setdefault((manuscript_id, span[0]), set()).add(str(annotation_id))
+    records = {}
+    for (manuscript_id, verse_key), annotation_ids in sorted(
+            wanted.items(), key=lambda item: verse_store.position(item[0][1]) or 0):
+        # Every wanted annotation of a verse in one pass over that verse's rows, in table order
+        for row in verse_annotations.get(manuscript_id, {}).get(verse_key, []):
+            if str(row['annotation_id']) in annotation_ids:
+                records.setdefault(manuscript_id, []).append(
+                    dict(row, token_span=token_index.span(manuscript_id, row['annotation_id'])))
+    return records
+
+
+def group_by_manuscript(records):
+    return [{
+        'manuscript_name': f"Manuscript {manuscript_id}",
+        'manuscript_id': manuscript_id,
+        'annotations': records.get(manuscript_id, [])
+    } for manuscript_id in annotations.keys()]
+
+
+@app.route('/get_verse_tokens', methods=['GET'])
+def get_verse_tokens():
+    """The words of a verse with their positions, normalized forms and the annotations placed on them"""
+    verse = request.args.get('verse', '')
+    tokens = token_index.tokens(verse)
+    if not tokens:
+        return jsonify({"error": "Verse not found"}), 404
+    results = []
+    for token in tokens:
+        references = sorted(token_index.token_annotations(verse, token['position']))
+        results.append(dict(token, annotations=[
+            {'manuscript_id': manuscript_id, 'annotation_id': annotation_id}
+            for manuscript_id, annotation_id in references
+        ]))
+    return jsonify(results)
+
+
+@app.route('/get_word_annotations', methods=['GET'])
+def get_word_annotations():
+    """All manuscripts' annotations on one word of a verse, e.g. ?verse=2:255&position=3"""
+    verse = request.args.get('verse', '')
+    position = request.args.get('position', 0, type=int)
+    token = token_index.token(verse, position)
+    if token is None:
+        return jsonify({"error": "Word not found"}), 404
+    records = annotation_records(token_index.token_annotations(verse, position))
+    return jsonify({'verse_id': verse, 'token': token, 'annotations': group_by_manuscript(records)})
+
+
+@app.route('/get_word_occurrences', methods=['GET'])
+def get_word_occurrences():
+    """
+    Every occurrence of a word across the corpus with the annotations placed on it. The word is given
+    as ?word=... or as ?verse=...&position=...; by=lemma matches on the light stem instead of the form.
+    """
+    by = request.args.get('by', 'form')
+    if by not in ('form', 'lemma'):
+        return jsonify({"error": "by must be form or lemma"}), 400
+    word = request.args.get('word', '')
+    verse = request.args.get('verse', '')
+    if verse:
+        token = token_index.token(verse, request.args.get('position', 0, type=int))
+        if token is None:
+            return jsonify({"error": "Word not found"}), 404
+        word = token['text']
+    if not word:
+        return jsonify({"error": "A word or a verse and position are required"}), 400
+
+    occurrences = token_index.find_occurrences(word, by=by)
+    references = set()
+    for verse_key, position in occurrences:
+        references.update(token_index.token_annotations(verse_key, position))
+    records = annotation_records(references)
+    by_reference = {(m, a['annotation_id']): a for m, rows in records.items() for a in rows}
+
+    results = []
+    for verse_key, position in occurrences:
+        token = token_index.token(verse_key, position)
+        results.append({
+            'verse_id': verse_key,
+            'position': position,
+            'text': token['text'],
+            'annotations': [by_reference[r] for r in sorted(token_index.token_annotations(verse_key, position))
+                            if r in by_reference]
+        })
+    return jsonify({'word': word, 'by': by, 'occurrences': results})
+
+
+@app.route('/get_annotation_aggregates', methods=['GET'])
+def get_annotation_aggregates():
+    """
+    Annotation counts grouped by manuscript, annotation_type and annotation_Language for a page, sura,
+    juz or verse range (the whole Quran when none is given), served from the materialized counts.
+    """
+    positions, error = selected_verse_positions(request.args)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    manuscript_ids, unknown = requested_manuscripts(request.args)
+    if unknown:
+        return jsonify({"error": f"Unknown manuscripts: {', '.join(unknown)}"}), 400
+    wanted = set(manuscript_ids)
+
+    if positions is None:
+        verse_counts = annotation_counts.values()
+    else:
+        verse_keys = [verse_store.key(p) for p in positions]
+        verse_counts = [annotation_counts[key] for key in verse_keys if key in annotation_counts]
+
+    totals = {}
+    for counts in verse_counts:
+        for key, count in counts.items():
+            if key[0] in wanted:
+                totals[key] = totals.get(key, 0) + count
+
+    by_manuscript = {m: 0 for m in manuscript_ids}
+    for (manuscript_id, _, _), count in totals.items():
+        by_manuscript[manuscript_id] += count
+    return jsonify({
+        # Number of verses in the selection, annotated or not
+        'verses': verse_store.size if positions is None else int(len(positions)),
+        'total': sum(by_manuscript.values()),
+        'by_manuscript': by_manuscript,
+        'counts': [{
+            'manuscript_id': manuscript_id,
+            'annotation_type': annotation_type,
+            'annotation_Language': language,
+            'count': count
+        } for (manuscript_id, annotation_type, language), count in sorted(totals.items())]
+    })
+
+
+@app.route('/get_changes', methods=['GET'])
+def get_changes():
+    """
+    Delta sync: return the inserts, updates and deletes recorded after `since`. When `reset` is
+    true the requested point is no longer retained and the client should reload everything.
+    """
+    since = request.args.get('since', 0, type=int)
+    with change_condition:
+        reset, changes = changes_since(since)
+        current = change_seq
+    return jsonify({'seq': current, 'reset': reset, 'changes': changes})
+
+
+@app.route('/stream_changes', methods=['GET'])
+def stream_changes():
+    """Push changes recorded after `since` (or the Last-Event-ID header) as server-sent events"""
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+
+    def generate(last_seq):
+        keep_alive_at = time.monotonic() + 15
+        while True:
+            if shared_state:
+                # Writes handled by other workers only show up once they are read from the log
+                sync_changes()
+            with change_condition:
+                if change_seq <= last_seq:
+                    change_condition.wait(timeout=1 if shared_state else 15)
+                reset, pending = changes_since(last_seq)
+                current = change_seq
+            if reset:
+                last_seq = current
+                yield f"id: {current}\nevent: reset\ndata: {json.dumps({'seq': current})}\n\n"
+                continue
+            if not pending:
+                if time.monotonic() >= keep_alive_at:
+                    # Comment line to keep proxies from closing an idle connection
+                    keep_alive_at = time.monotonic() + 15
+                    yield ": keep-alive\n\n"
+                continue
+            for change in pending:
+                last_seq = change['seq']
+                yield f"id: {last_seq}\nevent: change\ndata: {json.dumps(change, ensure_ascii=False, default=str)}\n\n"
+
+    return Response(generate(since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 if __name__ == '__main__':
+    # Development server; use serve.py to run several worker processes that share the verse data
     app.run(debug=True)
@@ -0,0 +1,166 @@
+"""
+In-memory repository for the saved annotation templates.
+
+Templates are kept in insertion order together with two hash indexes: template_id -> template
+and the normalized five-field combination -> template, so duplicate detection and id lookups do
+constant work however many templates accumulate. The last issued template id is persisted next to
+the workbook so ids are never handed out twice, even across restarts.
+"""
+import os
+import threading
+
+import pandas as pd
+
+template_columns = ["template_id", "template_name", "manuscript_id", "annotation", "annotation_Language",
+                    "annotation_transliteration", "annotation_type", "other", "created_date", "popularity"]
+
+# The fields that make up a template's content; two templates with the same values are duplicates
+template_fields = ['annotation', 'annotation_Language', 'annotation_transliteration', 'annotation_type', 'other']
+
+
+def template_key(data):
+    """Normalized combination of the template fields used by the dedupe index"""
+    return tuple(str(data.get(field, '') or '').strip() for field in template_fields)
+
+
+def numeric_template_id(template_id):
+    """Number of ids like "12" or "temp_12", or None if the id has no numeric part"""
+    try:
+        return int(template_id)
+    except ValueError:
+        if '_' in template_id:
+            try:
+                return int(template_id.split('_')[-1])
+            except ValueError:
+                pass
+    return None
+
+
+class TemplateRepository:
+    def __init__(self, template_file, sequence_file):
+        self.template_file = template_file
+        self.sequence_file = sequence_file
+        self.templates = []
+        self.by_id = {}
+        self.by_key = {}
+        self.last_id = 0
+        self.lock = threading.Lock()
+        # Templates by descending popularity, re-sorted only after a template was added or changed
+        self._by_popularity = None
+
+    def load(self):
+        """Load all saved templates from the workbook and build the indexes"""
+        self.templates = []
+        self.by_id = {}
+        self.by_key = {}
+        self.last_id = self._read_sequence()
+        if not os.path.exists(self.template_file):
+            return
+        try:
+            frame = pd.read_excel(self.template_file, dtype={
+                "template_id": str,
+                "template_name": str,
+                "manuscript_id": str,
+                "annotation": str,
+                "annotation_Language": str,
+                "annotation_transliteration": str,
+                "annotation_type": str,
+                "other": str,
+                "created_date": str,
+            })
+        except Exception as e:
+            print(f"Error loading templates: {e}")
+            return
+        # Ensure popularity column exists and has default values
+        if 'popularity' not in frame.columns:
+            frame['popularity'] = 1
+        frame['popularity'] = pd.to_numeric(frame['popularity'], errors='coerce').fillna(1).astype(int)
+        frame = frame.fillna('')
+        for template in frame.to_dict(orient='records'):
+            self._index(template)
+
+    def _index(self, template):
+        self._by_popularity = None
+        template['template_id'] = str(template.get('template_id', ''))
+        self.templates.append(template)
+        self.by_id.setdefault(template['template_id'], template)
+        self.by_key.setdefault(template_key(template), template)
+        number = numeric_template_id(template['template_id'])
+        if number is not None and number > self.last_id:
+            self.last_id = number
+
+    def _read_sequence(self):
+        try:
+            with open(self.sequence_file, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_sequence(self):
+        with open(self.sequence_file, 'w', encoding='utf-8') as f:
+            f.write(str(self.last_id))
+
+    def save(self):
+        """Write all templates back to the workbook"""
+        pd.DataFrame(self.templates, columns=template_columns).to_excel(self.template_file, index=False)
+
+    def rows(self):
+        return list(self.templates)
+
+    def popular(self):
+        """All templates, most popular first (ties in the order they were added)"""
+        by_popularity = self._by_popularity
+        if by_popularity is None:
+            with self.lock:
+                by_popularity = sorted(self.templates, key=lambda t: t['popularity'], reverse=True)
+                self._by_popularity = by_popularity
+        return by_popularity
+
+    def get(self, template_id):
+        return self.by_id.get(template_id)
+
+    def find_duplicate(self, data):
+        return self.by_key.get(template_key(data))
+
+    def next_id(self):
+        """Reserve and return the next template id"""
+        with self.lock:
+            # Another server process may have reserved ids since this one last did
+            self.last_id = max(self.last_id, self._read_sequence()) + 1
+            self._write_sequence()
+            return str(self.last_id)
+
+    def add(self, template, persist=True):
+        """Add a template unless one with the same fields exists; returns (template, created)"""
+        with self.lock:
+            existing = self.find_duplicate(template)
+            if existing is not None:
+                return existing, False
+            # A missing id, or one a client picked that is already taken, gets the next free id
+            if not template.get('template_id') or str(template['template_id']) in self.by_id:
+                self.last_id = max(self.last_id, self._read_sequence()) + 1
+                template['template_id'] = str(self.last_id)
+            self._index(template)
+            if persist:
+                self._write_sequence()
+                self.save()
+            return template, True
+
+    def update(self, template_id, fields):
+        """Apply changed fields (such as popularity) in memory, e.g. when replaying another process's write"""
+        with self.lock:
+            template = self.by_id.get(template_id)
+            if template is not None:
+                template.update(fields)
+                self._by_popularity = None
+
+    def increment_popularity(self, template_id):
+        """Increment a template's popularity and return the new value, or None if it does not exist"""
+        with self.lock:
+            template = self.by_id.get(template_id)
+            if template is None:
+                return None
+            template['popularity'] = int(template.get('popularity') or 0) + 1
+            self._by_popularity = None
+            self.save()
+            return template['popularity']
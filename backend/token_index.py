@@ -0,0 +1,215 @@
+"""
+Word-level index over the verse text.
+
+Every verse's aya_text is split into words once at startup. Each word keeps its 1-based position,
+its character span in aya_text (the offsets the frontend stores in annotated_range), its
+normalized form and a light stem. Annotations are resolved to a span of word positions when they
+are saved, so per-word and per-form queries across manuscripts are dictionary lookups.
+
+The words never change after startup and are packed into flat arrays and shared string buffers
+(see verse_store.py), so forked server workers share them; only the placement of annotations on
+words is kept in dictionaries, since it changes with every write.
+
+There is no morphological lexicon for the corpus, so the "lemma" of a word is approximated by a
+light stem: the normalized form without common proclitics, the article and frequent suffixes.
+"""
+import re
+
+import numpy as np
+
+from verse_store import PackedMultiMap, PackedStrings
+
+word_pattern = re.compile(r'\S+')
+
+# The Warsh text writes final ya as yeh barree, which the verse text normalization would drop
+_letter_table = str.maketrans({'ے': 'ي'})
+# Spelling differences between the Warsh text and annotators' input that should not prevent a
+# match: alef (written or dagger), hamza seats, alef maqsura and ta marbuta
+_key_table = str.maketrans({'ا': None, 'ء': None, 'ى': 'ي', 'ة': 'ه', 'ؤ': 'و', 'ئ': 'ي'})
+_prefixes = ('وال', 'فال', 'بال', 'كال', 'لل', 'ال')
+_suffixes = ('هما', 'كما', 'ها', 'هم', 'هن', 'كم', 'كن', 'نا', 'ون', 'ين', 'ات', 'ان', 'ة', 'ه')
+
+
+def word_key(normalized):
+    """Matching key of a normalized word"""
+    return normalized.translate(_key_table)
+
+
+def light_stem(normalized):
+    for prefix in _prefixes:
+        if normalized.startswith(prefix) and len(normalized) - len(prefix) >= 2:
+            normalized = normalized[len(prefix):]
+            break
+    else:
+        if normalized[:1] in ('و', 'ف') and len(normalized) > 3:
+            normalized = normalized[1:]
+    for suffix in _suffixes:
+        if normalized.endswith(suffix) and len(normalized) - len(suffix) >= 3:
+            normalized = normalized[:-len(suffix)]
+            break
+    return word_key(normalized)
+
+
+def parse_annotated_range(value):
+    """"18 - 23" -> (18, 23), or None"""
+    parts = str(value or '').split('-')
+    if len(parts) != 2:
+        return None
+    try:
+        start, end = int(parts[0]), int(parts[1])
+    except ValueError:
+        return None
+    return (start, end) if 0 <= start < end else None
+
+
+class TokenIndex:
+    def __init__(self, normalize):
+        self._normalize = normalize
+        self.span_by_annotation = {}
+        self.annotations_by_token = {}
+        self.build_verses([], [])
+
+    def normalize(self, text):
+        return self._normalize(text.translate(_letter_table))
+
+    def build_verses(self, verse_keys, verse_texts):
+        verses = []
+        token_offsets = [0]
+        columns = {'text': [], 'start': [], 'end': [], 'normalized': [], 'key': [], 'stem': []}
+        for verse_key, text in zip(verse_keys, verse_texts):
+            if not isinstance(text, str):
+                continue
+            for match in word_pattern.finditer(text):
+                normalized = self.normalize(match.group())
+                # Verse numbers and pause marks normalize to nothing and are not words
+                if not normalized:
+                    continue
+                columns['text'].append(match.group())
+                columns['start'].append(match.start())
+                columns['end'].append(match.end())
+                columns['normalized'].append(normalized)
+                columns['key'].append(word_key(normalized))
+                columns['stem'].append(light_stem(normalized))
+            verses.append(str(verse_key))
+            token_offsets.append(len(columns['text']))
+
+        # Token ids number the words of the corpus in order; the words of verse v are the ids
+        # token_offsets[v] up to token_offsets[v + 1]
+        self.verse_keys = PackedStrings(verses)
+        self.verse_numbers = PackedMultiMap((verse_key, v) for v, verse_key in enumerate(verses))
+        self.token_offsets = np.array(token_offsets, dtype=np.int64)
+        self.token_verse = np.repeat(np.arange(len(verses), dtype=np.int64), np.diff(self.token_offsets))
+        self.token_start = np.array(columns['start'], dtype=np.int64)
+        self.token_end = np.array(columns['end'], dtype=np.int64)
+        self.token_text = PackedStrings(columns['text'])
+        self.token_normalized = PackedStrings(columns['normalized'])
+        self.token_key = PackedStrings(columns['key'])
+        self.token_stem = PackedStrings(columns['stem'])
+        self.occurrences = PackedMultiMap((key, t) for t, key in enumerate(columns['key']))
+        self.stem_occurrences = PackedMultiMap((stem, t) for t, stem in enumerate(columns['stem']))
+
+    def _token(self, token_id, first_id):
+        return {
+            'position': token_id - first_id + 1,
+            'text': self.token_text[token_id],
+            'start': int(self.token_start[token_id]),
+            'end': int(self.token_end[token_id]),
+            'normalized': self.token_normalized[token_id],
+            'key': self.token_key[token_id],
+            'stem': self.token_stem[token_id],
+        }
+
+    def tokens(self, verse_key):
+        """The words of a verse, an empty list for an unknown verse"""
+        found = self.verse_numbers.get(str(verse_key))
+        if not len(found):
+            return []
+        first, last = int(self.token_offsets[found[0]]), int(self.token_offsets[found[0] + 1])
+        return [self._token(t, first) for t in range(first, last)]
+
+    def token(self, verse_key, position):
+        """The word at a 1-based position of a verse, or None"""
+        found = self.verse_numbers.get(str(verse_key))
+        if not len(found):
+            return None
+        first, last = int(self.token_offsets[found[0]]), int(self.token_offsets[found[0] + 1])
+        if not 1 <= position <= last - first:
+            return None
+        return self._token(first + position - 1, first)
+
+    def _location(self, token_id):
+        """(verse_key, position) of a token id"""
+        verse = int(self.token_verse[token_id])
+        return self.verse_keys[verse], token_id - int(self.token_offsets[verse]) + 1
+
+    def resolve(self, annotation):
+        """(first, last) word positions an annotation refers to, or None if it cannot be placed"""
+        tokens = self.tokens(annotation.get('verse_id', ''))
+        if not tokens:
+            return None
+        object_keys = [word_key(w) for w in self.normalize(str(annotation.get('annotated_object') or '')).split()]
+
+        # The selected character range is exact, as long as it still covers the annotated object
+        char_range = parse_annotated_range(annotation.get('annotated_range'))
+        if char_range is not None:
+            covered = [t for t in tokens if t['start'] < char_range[1] and t['end'] > char_range[0]]
+            if covered and (not object_keys or [t['key'] for t in covered] == object_keys):
+                return covered[0]['position'], covered[-1]['position']
+
+        # Otherwise look for the annotated words as a consecutive run in the verse
+        if object_keys:
+            keys = [t['key'] for t in tokens]
+            for i in range(len(keys) - len(object_keys) + 1):
+                if keys[i:i + len(object_keys)] == object_keys:
+                    return tokens[i]['position'], tokens[i + len(object_keys) - 1]['position']
+        return None
+
+    def add_annotation(self, manuscript_id, annotation_id, annotation):
+        span = self.resolve(annotation)
+        if span is None:
+            return
+        reference = (manuscript_id, str(annotation_id))
+        verse_key = str(annotation['verse_id'])
+        self.span_by_annotation[reference] = (verse_key, span[0], span[1])
+        for position in range(span[0], span[1] + 1):
+            self.annotations_by_token.setdefault((verse_key, position), set()).add(reference)
+
+    def remove_annotation(self, manuscript_id, annotation_id):
+        reference = (manuscript_id, str(annotation_id))
+        located = self.span_by_annotation.pop(reference, None)
+        if located is None:
+            return
+        verse_key, first, last = located
+        for position in range(first, last + 1):
+            references = self.annotations_by_token.get((verse_key, position))
+            if references is not None:
+                references.discard(reference)
+                if not references:
+                    del self.annotations_by_token[(verse_key, position)]
+
+    def update_annotation(self, manuscript_id, annotation_id, annotation):
+        self.remove_annotation(manuscript_id, annotation_id)
+        self.add_annotation(manuscript_id, annotation_id, annotation)
+
+    def build_annotations(self, manuscript_id, frame):
+        for annotation in frame.to_dict(orient='records'):
+            self.add_annotation(manuscript_id, annotation['annotation_id'], annotation)
+
+    def span(self, manuscript_id, annotation_id):
+        located = self.span_by_annotation.get((manuscript_id, str(annotation_id)))
+        return None if located is None else {'first': located[1], 'last': located[2]}
+
+    def token_annotations(self, verse_key, position):
+        """(manuscript_id, annotation_id) pairs annotating a word"""
+        return self.annotations_by_token.get((verse_key, position), set())
+
+    def find_occurrences(self, word, by='form'):
+        """(verse_key, position) of every word with the same normalized form (or light stem) as `word`"""
+        normalized = self.normalize(word).strip()
+        if not normalized or len(normalized.split()) != 1:
+            return []
+        if by == 'lemma':
+            token_ids = self.stem_occurrences.get(light_stem(normalized))
+        else:
+            token_ids = self.occurrences.get(word_key(normalized))
+        return [self._location(int(t)) for t in token_ids]
@@ -0,0 +1,124 @@
+"""
+Query planner for the verse search box.
+
+A query is split into terms and each term is recognised as one kind of selector:
+
+* an AyahKey prefix such as "2:25" or "2" (any term starting with a digit)
+* a page, juz or sura selector: "page:3", "p:3-4", "juz:30", "j:30", "sura:2", "s:2", "sura:baqarah"
+* a sura name: English names in Latin script, matched without diacritics ("al-baqarah", "fatiha"),
+  Arabic names after the word سورة ("سورة البقرة")
+* anything else in Arabic script is searched for in the normalized verse text
+
+The plan is a sorted tuple of those terms, so queries that differ only in term order or spelling
+of the selectors share a plan. The server runs the index lookups of a plan first, intersects
+them and searches the text only within the verses they leave.
+"""
+import re
+import unicodedata
+
+selector_pattern = re.compile(r'^([A-Za-z]+):(.*)$')
+arabic_pattern = re.compile(r'[؀-ۿݐ-ݿ]')
+
+# Selector names and their short forms
+selectors = {'page': 'page', 'p': 'page', 'juz': 'juz', 'j': 'juz', 'sura': 'sura', 's': 'sura'}
+sura_words = {'سورة', 'سوره'}
+# Article the English sura names start with, which users often leave out
+_english_articles = ('al', 'an', 'ar', 'as', 'ash', 'at', 'az', 'ad', 'adh')
+
+
+def parse_range(value):
+    """Parse "3" or "3-5" into an inclusive (low, high) pair, or None if malformed."""
+    parts = [p.strip() for p in str(value).split('-', 1)]
+    try:
+        low = int(parts[0])
+        high = int(parts[1]) if len(parts) > 1 and parts[1] else low
+    except ValueError:
+        return None
+    return (low, high) if low <= high else (high, low)
+
+
+def fold_latin(text):
+    """"Āl-‘Imrān" -> "alimran": without diacritics, punctuation, spaces and case"""
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    return ''.join(c for c in decomposed if c.isalnum() and not unicodedata.combining(c)).casefold()
+
+
+class QueryPlanner:
+    def __init__(self, suras, normalize):
+        """`suras` are (sura number, English name, Arabic name) triples"""
+        self.normalize = normalize
+        self.english_names = {}
+        self.arabic_names = {}
+        for number, name_en, name_ar in suras:
+            folded = fold_latin(name_en)
+            self.english_names.setdefault(folded, set()).add(number)
+            for article in _english_articles:
+                if folded.startswith(article) and len(folded) > len(article) + 2:
+                    self.english_names.setdefault(folded[len(article):], set()).add(number)
+            self.arabic_names.setdefault(normalize(str(name_ar)), set()).add(number)
+
+    def english_suras(self, text):
+        """Numbers of the suras whose English name is, or starts with, `text`"""
+        folded = fold_latin(text)
+        if not folded:
+            return set()
+        if folded in self.english_names:
+            return self.english_names[folded]
+        if len(folded) < 3:
+            return set()
+        return {n for name, numbers in self.english_names.items() if name.startswith(folded) for n in numbers}
+
+    def plan(self, query):
+        """Sorted tuple of the query's terms; empty for an empty query"""
+        terms = set()
+        arabic_words = []
+        latin_words = []
+        for word in query.split():
+            selector = selector_pattern.match(word)
+            if selector and selector.group(1).lower() in selectors:
+                kind, value = selectors[selector.group(1).lower()], selector.group(2)
+                bounds = parse_range(value)
+                if bounds is not None:
+                    terms.add(('range', kind) + bounds)
+                elif kind == 'sura':
+                    terms.add(self._suras_term(self.english_suras(value)))
+                else:
+                    terms.add(('none',))
+            elif word[0].isdigit():
+                terms.add(('key', word))
+            elif arabic_pattern.search(word):
+                arabic_words.append(word)
+            else:
+                latin_words.append(word)
+
+        if latin_words:
+            terms.add(self._suras_term(self.english_suras(' '.join(latin_words))))
+
+        text_words = []
+        i = 0
+        while i < len(arabic_words):
+            if self.normalize(arabic_words[i]) in sura_words:
+                # The longest run of following words that is a sura name
+                for j in range(len(arabic_words), i + 1, -1):
+                    numbers = self.arabic_names.get(self.normalize(' '.join(arabic_words[i + 1:j])))
+                    if numbers:
+                        terms.add(self._suras_term(numbers))
+                        i = j
+                        break
+                else:
+                    text_words.append(arabic_words[i])
+                    i += 1
+                continue
+            text_words.append(arabic_words[i])
+            i += 1
+        text = self.normalize(' '.join(text_words)) if text_words else ''
+        if text:
+            terms.add(('text', text))
+        elif text_words:
+            # Only symbols or diacritics, which the verse text does not contain
+            terms.add(('none',))
+        return tuple(sorted(terms))
+
+    @staticmethod
+    def _suras_term(numbers):
+        return ('suras', tuple(sorted(numbers))) if numbers else ('none',)
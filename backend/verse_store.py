@@ -0,0 +1,142 @@
+"""
+Immutable verse data packed into flat buffers.
+
+The verse table never changes after startup, yet a DataFrame of Python strings gets its reference
+counts touched on every access, which makes forked workers copy the pages they read. This store
+packs what the request paths need into a few flat byte buffers held in a shared anonymous memory
+map, plus numpy offset arrays:
+
+* the normalized searchable_text of every verse, separated by newlines, searched with mmap.find
+* the AyahKeys, newline separated, for prefix lookups, and a sorted copy for exact lookups
+* the JSON serialization of every verse record, so results are assembled by slicing bytes
+
+Built once in the master process before forking (see serve.py), the buffers are shared by all
+workers instead of being rebuilt or copied per process. PackedStrings and PackedMultiMap are also
+used for the word index (see token_index.py).
+"""
+import bisect
+import json
+import mmap
+
+import numpy as np
+
+
+def _pack(items):
+    """Pack byte strings into one shared buffer with a leading newline and a newline after each item"""
+    data = b'\n' + b''.join(item + b'\n' for item in items)
+    buffer = mmap.mmap(-1, len(data))
+    buffer.write(data)
+    lengths = np.fromiter((len(item) + 1 for item in items), dtype=np.int64, count=len(items))
+    # offsets[i] is where item i starts, offsets[-1] is the end of the buffer
+    offsets = np.concatenate(([1], 1 + np.cumsum(lengths))).astype(np.int64)
+    return buffer, offsets
+
+
+class PackedStrings:
+    """A read-only sequence of strings (without newlines) packed into one shared buffer"""
+
+    def __init__(self, items):
+        self.buffer, self.offsets = _pack([str(item).encode('utf-8') for item in items])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        return self.buffer[int(self.offsets[i]):int(self.offsets[i + 1]) - 1]
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+
+class PackedMultiMap:
+    """
+    Read-only map from strings to groups of integers: the sorted distinct keys are packed in a
+    shared buffer and found by binary search, the values are one array grouped by key, each
+    group in insertion order.
+    """
+
+    def __init__(self, pairs):
+        groups = {}
+        for key, value in pairs:
+            groups.setdefault(key, []).append(value)
+        keys = sorted(groups)
+        self.keys = PackedStrings(keys)
+        self.offsets = np.concatenate(([0], np.cumsum([len(groups[k]) for k in keys]))).astype(np.int64)
+        self.values = np.fromiter((v for k in keys for v in groups[k]), dtype=np.int64,
+                                  count=int(self.offsets[-1]))
+
+    def get(self, key):
+        """Values of `key`, an empty array if it is not in the map"""
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.values[self.offsets[i]:self.offsets[i + 1]]
+        return self.values[:0]
+
+
+class VerseStore:
+    def __init__(self, records, searchable_texts, verse_keys):
+        self.size = len(records)
+        self.texts = PackedStrings(searchable_texts)
+        self.keys = PackedStrings(verse_keys)
+        self.positions = PackedMultiMap((str(key), p) for p, key in enumerate(verse_keys))
+        self.records = PackedStrings(
+            json.dumps(record, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+            for record in records
+        )
+
+    @classmethod
+    def from_frame(cls, df, text_column='searchable_text', key_column='AyahKey'):
+        df = df.fillna('')
+        return cls(df.to_dict(orient='records'), df[text_column].tolist(), df[key_column].tolist())
+
+    def _find(self, packed, needle, lead=0):
+        """
+        Positions of the items containing `needle`, each reported once, in order. `lead` is the
+        number of separator bytes the needle starts with before the item's own bytes.
+        """
+        buffer, offsets = packed.buffer, packed.offsets
+        positions = []
+        found = buffer.find(needle, 0)
+        while found != -1:
+            position = int(np.searchsorted(offsets, found + lead, side='right')) - 1
+            positions.append(position)
+            # Continue after the end of this item so it is not reported twice
+            found = buffer.find(needle, int(offsets[position + 1]) - lead)
+        return np.array(positions, dtype=np.int64)
+
+    def search_text(self, query, positions=None):
+        """
+        Verse positions whose searchable_text contains `query` (a plain substring, not a regex),
+        among `positions` when given, otherwise among all verses
+        """
+        needle = query.encode('utf-8')
+        if not needle or b'\n' in needle:
+            return np.array([], dtype=np.int64)
+        if positions is None:
+            return self._find(self.texts, needle)
+        offsets = self.texts.offsets
+        return np.array([p for p in positions
+                         if self.texts.buffer.find(needle, int(offsets[p]), int(offsets[p + 1]) - 1) != -1],
+                        dtype=np.int64)
+
+    def search_key_prefix(self, prefix):
+        """Verse positions whose AyahKey starts with `prefix`"""
+        if '\n' in prefix:
+            return np.array([], dtype=np.int64)
+        # Every key is preceded by a newline, so matching it anchors the prefix at the key start
+        return self._find(self.keys, b'\n' + prefix.encode('utf-8'), lead=1)
+
+    def position(self, verse_key):
+        """Row position of the verse with this AyahKey, or None"""
+        found = self.positions.get(str(verse_key))
+        return int(found[0]) if len(found) else None
+
+    def key(self, position):
+        return self.keys[position]
+
+    def record_json(self, position):
+        return self.records.raw(position)
+
+    def records_json(self, positions):
+        """JSON array of the verse records at `positions`, assembled from the packed serializations"""
+        return b'[' + b','.join(self.record_json(p) for p in positions) + b']'